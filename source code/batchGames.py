@@ -0,0 +1,157 @@
+'''
+Batch simulator for Short Circuit.
+
+Steps thousands of independent games of the same level at once, for
+automated playtesting and agent training.  Player positions, turn counters,
+goals left and detection are NumPy arrays with one entry per game, and each
+step applies one move per game with the same rules as GameState.step
+(getMoveTable and the dish rotation in DetectionSchedule), as array lookups.
+
+Needs NumPy, which the game itself does not.
+
+Usage: python batchGames.py [levels file] [number of games]
+'''
+
+import sys, os, time
+import numpy
+import shortCircuit
+
+# the column of BatchGames.nextCell for a move that isn't a direction
+NO_MOVE = 6
+
+
+class BatchGames:
+    '''count games of one level.  Hexes are numbered y*width + x, like the
+    bits of a Bitboard.'''
+    def __init__(self, levelDict, count, schedule=None):
+        '''schedule is the level's DetectionSchedule, built here if not given.'''
+        if schedule == None:
+            schedule = shortCircuit.DetectionSchedule(levelDict)
+        bitboard = schedule.getBitboard()
+        assert len(levelDict['goalAddresses']) <= 64, 'BatchGames keeps the goals left in 64 bits.'
+        self.levelDict = levelDict
+        self.count = count
+        self.width = bitboard.getWidth()
+        self.period = schedule.getPeriod()
+        hexCount = bitboard.getWidth()*bitboard.getHeight()
+
+        # nextCell[hex, direction] is where that move ends up (the same hex
+        # if the move isn't possible)
+        self.nextCell = numpy.empty((hexCount, NO_MOVE + 1), numpy.int32)
+        for (address, moves) in shortCircuit.getMoveTable(bitboard).items():
+            here = self.getHex(address)
+            self.nextCell[here, :] = here
+            for (direction, newAddress) in moves.items():
+                self.nextCell[here, direction] = self.getHex(newAddress)
+
+        # detectedAt[turn % period, hex]
+        self.detectedAt = numpy.zeros((self.period, hexCount), numpy.bool_)
+        for turn in range(self.period):
+            for address in bitboard.getAddresses(schedule.getDetectedMask(turn)):
+                self.detectedAt[turn, self.getHex(address)] = True
+
+        # goalBitAt[hex] is the bit of the goal there, or 0
+        self.goalBitAt = numpy.zeros(hexCount, numpy.uint64)
+        for i, address in enumerate(levelDict['goalAddresses']):
+            self.goalBitAt[self.getHex(address)] = numpy.uint64(1 << i)
+        self.allGoals = numpy.uint64((1 << len(levelDict['goalAddresses'])) - 1)
+
+        self.startHex = self.getHex(levelDict['playerAddress'])
+        self.positions = numpy.empty(count, numpy.int32)
+        self.facings = numpy.empty(count, numpy.int8)
+        self.turns = numpy.empty(count, numpy.int64)
+        self.goalsLeft = numpy.empty(count, numpy.uint64)
+        self.detected = numpy.empty(count, numpy.bool_)
+        self.reset()
+
+    def getHex(self, address):
+        (x, y) = address
+        return y*self.width + x
+
+    def reset(self, which=None):
+        '''Restarts the games picked by which (a boolean array or index
+        array), or all of them if which is None.'''
+        if which is None:
+            which = slice(None)
+        self.positions[which] = self.startHex
+        self.facings[which] = shortCircuit.RIGHT
+        self.turns[which] = 0
+        self.goalsLeft[which] = self.allGoals
+        self.detected[which] = self.detectedAt[0, self.startHex]
+
+    def step(self, moves):
+        '''moves is an array of one direction per game; anything that isn't a
+        direction does nothing, as in GameState.step, and games that are over don't
+        move.  Returns the arrays (detected, complete).'''
+        moves = numpy.asarray(moves)
+        playing = ~self.detected & (self.goalsLeft != 0)
+        isDirection = playing & (moves >= 0) & (moves < NO_MOVE)
+        columns = numpy.where(isDirection, moves, NO_MOVE)
+
+        newPositions = self.nextCell[self.positions, columns]
+        moved = newPositions != self.positions
+        # GameState.step turns the player even if the move isn't possible
+        self.facings[isDirection] = moves[isDirection]
+        self.positions = newPositions
+        self.turns += moved
+
+        self.goalsLeft = numpy.where(moved, self.goalsLeft & ~self.goalBitAt[newPositions], self.goalsLeft)
+        self.detected |= moved & self.detectedAt[self.turns % self.period, newPositions]
+        return self.detected, self.isComplete()
+
+    def getCount(self):
+        return self.count
+
+    def getPlayerAddresses(self):
+        '''Returns the arrays (x, y) of the player in each game.'''
+        return self.positions % self.width, self.positions // self.width
+
+    def getFacings(self):
+        return self.facings
+
+    def getTurns(self):
+        return self.turns
+
+    def getGoalsLeft(self):
+        '''Returns an array of bitmasks of the goals not yet reached; bit i
+        stands for levelDict['goalAddresses'][i].'''
+        return self.goalsLeft
+
+    def isDetected(self):
+        return self.detected
+
+    def isComplete(self):
+        '''Returns a boolean array of the games that have been won.'''
+        return (self.goalsLeft == 0) & ~self.detected
+
+
+def main():
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'sclevels.data')
+    count = 100000
+    if len(sys.argv) > 1:
+        filename = sys.argv[1]
+    if len(sys.argv) > 2:
+        count = int(sys.argv[2])
+
+    # random play on every level, restarting games as they end
+    levels = shortCircuit.readLevelsFile(filename)
+    random = numpy.random.RandomState(0)
+    totalSteps = 0
+    totalTime = 0.0
+    for levelNum, levelDict in enumerate(levels):
+        games = BatchGames(levelDict, count)
+        moves = random.randint(0, 6, (20, count))
+        wins = 0
+        startTime = time.time()
+        for i in range(len(moves)):
+            detected, complete = games.step(moves[i])
+            wins += complete.sum()
+            games.reset(detected | complete)
+        stepTime = time.time() - startTime
+        totalSteps += moves.size
+        totalTime += stepTime
+        print 'Level %s: %.1f million steps/s, %s random wins' % (levelNum + 1, moves.size/stepTime/1e6, wins)
+    print '%s games per level: %.1f million steps/s overall' % (count, totalSteps/totalTime/1e6)
+
+if __name__ == '__main__':
+    main()
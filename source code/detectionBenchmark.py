@@ -0,0 +1,270 @@
+'''
+Detection benchmarks for Short Circuit.
+
+Times the detection engine (Bitboard.getDetectedMask, Gameboard.getDetectedTiles
+with and without its cache, and Gameboard.getTilesInZone) on every level in
+the level pack and on random boards from 10x10 up to 500x500 (Gameboard only up
+to MAX_GAMEBOARD_SIDE, for the memory its surface takes), and reports calls
+per second and p50/p99 latency.  The original scan-and-sets detection code is kept below as a
+reference, and every engine is checked hex-for-hex against it, for every dish
+position and facing, before anything is timed.
+
+Usage: python detectionBenchmark.py [levels file] [--budget SECONDS]
+'''
+
+import pygame, sys, os, time, random
+import shortCircuit
+from shortCircuit import RIGHT, UPRIGHT, UPLEFT, LEFT, DOWNLEFT, DOWNRIGHT, REDTINT
+
+DIRECTIONS = (RIGHT, UPRIGHT, UPLEFT, LEFT, DOWNLEFT, DOWNRIGHT)
+
+# seconds spent timing each engine on each board
+TIME_BUDGET = 0.2
+
+# random boards to time, and the biggest of them to check against the
+# reference (which scans the whole board for every half-cone)
+BOARD_SIZES = (10, 25, 50, 100, 250, 500)
+WALL_DENSITIES = (0.0, 0.01, 0.05)
+DISH_COUNTS = (1, 8)
+MAX_REFERENCE_SIDE = 50
+# the biggest random boards to time Gameboard on; its board surface is about
+# 48 MB at 100x100 and grows with the board's area
+MAX_GAMEBOARD_SIDE = 100
+CHECKED_BOARDS = ((1, 1), (6, 6), (9, 14), (16, 9), (20, 20))
+
+
+def referenceAddressesInZone(width, height, walls, address, righthandDir):
+    '''The original Gameboard.getTilesInZone, on addresses.  Returns a list of
+    the addresses in the half-cone and a list of those with walls.'''
+    (a, b) = address
+    addresses = []
+    addressesWithWalls = []
+    for h in range(width):
+        # for computing
+        # k - b >= line1 are hexes below or on UPRIGHT line
+        # k - b <= -line1 are hexes above or on DOWNRIGHT line
+        line1 = -2*(h - a + (b+1)%2) + .1*((b+1)%2)
+        # k - b >= line2 are hexes below or on UPLEFT line
+        # k - b <= -line2 are hexes above or on DOWNLEFT line
+        line2 = 2*(h - a - b%2) + .1*(b%2)
+        for k in range(height):
+            inZone = False
+            if righthandDir == RIGHT and line1 <= k - b <= 0:
+                inZone = True
+            elif righthandDir == UPRIGHT and k - b <= -line2 and k - b <= -line1:
+                inZone = True
+            elif righthandDir == UPLEFT and k - b <= 0 and k - b >= line2:
+                inZone = True
+            elif righthandDir == LEFT and 0 <= k - b <= -line2:
+                inZone = True
+            elif righthandDir == DOWNLEFT and k - b >= line1 and k - b >= line2:
+                inZone = True
+            elif righthandDir == DOWNRIGHT and k - b >= 0 and k - b <= -line1:
+                inZone = True
+
+            if inZone:
+                addresses.append((h, k))
+                if (h, k) in walls:
+                    addressesWithWalls.append((h, k))
+    return addresses, addressesWithWalls
+
+def referenceDetectedAddresses(width, height, walls, dishAddress, mainDir):
+    '''The original Gameboard.getDetectedTiles, on addresses.  walls is a set.'''
+    (x, y) = dishAddress
+    (dx, dy) = shortCircuit.getdxdy((x, y), mainDir)
+    startAddress = (x + dx, y + dy)
+    if not (0 <= x + dx < width and 0 <= y + dy < height) or startAddress in walls:
+        return []
+    offDir = (mainDir - 1) % 6
+    righthandAddresses, righthandWalls = referenceAddressesInZone(width, height, walls, startAddress, offDir)
+    lefthandAddresses, lefthandWalls = referenceAddressesInZone(width, height, walls, startAddress, mainDir)
+
+    addresses = set(righthandAddresses) | set(lefthandAddresses)
+
+    blockingWalls = []
+    for rightWall in set(righthandWalls) - set(lefthandWalls):
+        blockingWalls.append((rightWall, offDir))
+    for leftWall in set(lefthandWalls) - set(righthandWalls):
+        blockingWalls.append((leftWall, mainDir))
+    # remove half-cones because of walls off the center line
+    for (wall, righthandDir) in blockingWalls:
+        addresses -= set(referenceAddressesInZone(width, height, walls, wall, righthandDir)[0])
+
+    # remove center line beyond walls
+    for centerWall in set(righthandWalls) & set(lefthandWalls):
+        addresses -= set(referenceAddressesInZone(width, height, walls, centerWall, mainDir)[0]) \
+                     & set(referenceAddressesInZone(width, height, walls, centerWall, offDir)[0])
+    return list(addresses)
+
+
+def setupImages():
+    '''Tile, Gameboard and DishSprite need IMAGESDICT to exist; what is in it
+    doesn't matter to detection, so blank tiles will do.'''
+    tileSurf = pygame.Surface((shortCircuit.SIDE_OF_TILE, shortCircuit.SIDE_OF_TILE))
+    shortCircuit.IMAGESDICT = {'tile':      tileSurf,
+                               'wall':      tileSurf,
+                               'UncGoal':   tileSurf,
+                               'CompGoal':  tileSurf,
+                               'c':         (tileSurf,)*6,
+                               'dish':      (tileSurf,)*6}
+
+def makeBitboard(width, height, walls):
+    bitboard = shortCircuit.Bitboard(width, height)
+    for address in walls:
+        bitboard.buildWallAt(address)
+    return bitboard
+
+def makeGameboard(width, height, walls):
+    gameboard = shortCircuit.Gameboard(width, height, (0, 0))
+    for address in walls:
+        gameboard.buildWallAt(address)
+    return gameboard
+
+def makeRandomBoard(width, height, wallDensity, dishCount, seed):
+    '''Returns (walls, dishes): a set of wall addresses and a list of
+    (address, facing) for dishes on open hexes.'''
+    rng = random.Random(seed)
+    walls = set()
+    openAddresses = []
+    for x in range(width):
+        for y in range(height):
+            if rng.random() < wallDensity:
+                walls.add((x, y))
+            else:
+                openAddresses.append((x, y))
+    dishes = [(rng.choice(openAddresses), rng.choice(DIRECTIONS)) for i in range(dishCount)]
+    return walls, dishes
+
+
+def checkBoard(width, height, walls, gameboard=None):
+    '''Compares the engine with the reference for a dish on every hex with
+    every facing.  Returns the number of mismatches.'''
+    bitboard = makeBitboard(width, height, walls)
+    mismatches = 0
+    for x in range(width):
+        for y in range(height):
+            for direction in DIRECTIONS:
+                expected = sorted(referenceAddressesInZone(width, height, walls, (x, y), direction)[0])
+                if sorted(shortCircuit.getAddressesInZone(width, height, (x, y), direction)) != expected:
+                    print '  zone mismatch: %sx%s board, (%s, %s), direction %s' % (width, height, x, y, direction)
+                    mismatches += 1
+
+                expected = sorted(referenceDetectedAddresses(width, height, walls, (x, y), direction))
+                detected = sorted(bitboard.getAddresses(bitboard.getDetectedMask((x, y), direction)))
+                if detected != expected:
+                    print '  bitboard mismatch: %sx%s board, dish at (%s, %s) facing %s' % (width, height, x, y, direction)
+                    mismatches += 1
+                if gameboard != None:
+                    dish = shortCircuit.DishSprite(REDTINT, (x, y), direction)
+                    detected = sorted(tile.getAddress() for tile in gameboard.getDetectedTiles(dish))
+                    if detected != expected:
+                        print '  gameboard mismatch: %sx%s board, dish at (%s, %s) facing %s' % (width, height, x, y, direction)
+                        mismatches += 1
+    return mismatches
+
+
+def timeCalls(function, argsList, budget):
+    '''Calls function(*args) for args in argsList, over and over, until budget
+    seconds have gone by (at least once through the list).
+    Returns a list of the time each call took, in seconds.'''
+    timer = time.time
+    latencies = []
+    endTime = timer() + budget
+    while True:
+        for args in argsList:
+            startTime = timer()
+            function(*args)
+            latencies.append(timer() - startTime)
+        if timer() >= endTime:
+            return latencies
+
+def reportLatencies(name, latencies):
+    '''Prints calls per second and p50/p99 latency in microseconds.'''
+    latencies = sorted(latencies)
+    p50 = latencies[int(round(.50*(len(latencies) - 1)))]
+    p99 = latencies[int(round(.99*(len(latencies) - 1)))]
+    print '  %-34s %12.0f calls/s   p50 %10.1f us   p99 %10.1f us' \
+          % (name, len(latencies)/max(sum(latencies), 1e-9), p50*1e6, p99*1e6)
+
+def timeBoard(width, height, walls, dishes, budget, gameboard=None):
+    '''Times every engine on the board.  dishes is a list of (address, facing).'''
+    referenceWalls = set(walls)
+    if max(width, height) <= MAX_REFERENCE_SIDE:
+        reportLatencies('reference getDetectedTiles',
+            timeCalls(lambda address, facing: referenceDetectedAddresses(width, height, referenceWalls, address, facing),
+                      dishes, budget))
+
+    # a new bitboard, so its first calls pay for building the half-cones
+    bitboard = makeBitboard(width, height, walls)
+    reportLatencies('Bitboard.getDetectedMask', timeCalls(bitboard.getDetectedMask, dishes, budget))
+
+    if gameboard != None:
+        dishSprites = [(shortCircuit.DishSprite(REDTINT, address, facing),) for (address, facing) in dishes]
+        def getDetectedTilesCold(dish):
+            # so every call goes through the bitboard, not detectionCache
+            gameboard.detectionCache.clear()
+            return gameboard.getDetectedTiles(dish)
+        reportLatencies('Gameboard.getDetectedTiles (cold)', timeCalls(getDetectedTilesCold, dishSprites, budget))
+        reportLatencies('Gameboard.getDetectedTiles (cached)', timeCalls(gameboard.getDetectedTiles, dishSprites, budget))
+
+        homes = [(gameboard.getArray()[x][y], facing) for ((x, y), facing) in dishes]
+        if max(width, height) <= MAX_REFERENCE_SIDE:
+            reportLatencies('reference getTilesInZone',
+                timeCalls(lambda tile, facing: referenceAddressesInZone(width, height, referenceWalls, tile.getAddress(), facing),
+                          homes, budget))
+        reportLatencies('Gameboard.getTilesInZone', timeCalls(gameboard.getTilesInZone, homes, budget))
+
+
+def main():
+    filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'sclevels.data')
+    budget = TIME_BUDGET
+    args = sys.argv[1:]
+    while args:
+        arg = args.pop(0)
+        if arg == '--budget':
+            budget = float(args.pop(0))
+        else:
+            filename = arg
+
+    setupImages()
+    levels = shortCircuit.readLevelsFile(filename)
+
+    print 'Checking against the reference detection...'
+    mismatches = 0
+    for levelNum, levelDict in enumerate(levels):
+        width, height, walls = levelDict['width'], levelDict['height'], levelDict['wallAddresses']
+        mismatches += checkBoard(width, height, set(walls), makeGameboard(width, height, walls))
+    for (width, height) in CHECKED_BOARDS:
+        for wallDensity in WALL_DENSITIES + (0.2,):
+            walls, dishes = makeRandomBoard(width, height, wallDensity, 0, (width, height, wallDensity))
+            mismatches += checkBoard(width, height, walls, makeGameboard(width, height, walls))
+    print '%s mismatches' % (mismatches)
+
+    print
+    print 'Level pack (%s, %s levels)' % (filename, len(levels))
+    for levelNum, levelDict in enumerate(levels):
+        width, height, walls = levelDict['width'], levelDict['height'], levelDict['wallAddresses']
+        print 'Level %s: %sx%s, %s walls, %s dishes' % (levelNum + 1, width, height, len(walls), len(levelDict['dishes']))
+        # each dish with every facing, as runLevel sees over a level
+        dishes = [(address, facing) for (tint, address, startFacing) in levelDict['dishes']
+                  for facing in DIRECTIONS]
+        if dishes:
+            timeBoard(width, height, walls, dishes, budget, makeGameboard(width, height, walls))
+
+    print
+    print 'Random boards'
+    for side in BOARD_SIZES:
+        for wallDensity in WALL_DENSITIES:
+            for dishCount in DISH_COUNTS:
+                walls, dishes = makeRandomBoard(side, side, wallDensity, dishCount, (side, wallDensity, dishCount))
+                print '%sx%s, %s walls, %s dishes' % (side, side, len(walls), dishCount)
+                if side <= MAX_GAMEBOARD_SIDE:
+                    timeBoard(side, side, walls, dishes, budget, makeGameboard(side, side, walls))
+                else:
+                    timeBoard(side, side, walls, dishes, budget)
+
+    if mismatches > 0:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ Uses an external level pack.
 7/31/2012
 '''
 
-import pygame, sys, os, copy, random
+import pygame, sys, os, random, fractions, time, collections, multiprocessing, multiprocessing.pool, marshal, hashlib, itertools
 from pygame.locals import *
 
 FPS = 30
@@ -33,6 +33,10 @@ BLUE = (0, 100, 255)
 REDTINT = (255, 0, 0, 130)
 BLUETINT = (0, 100, 255, 130)
 
+# dishes turn counterclockwise once every this many turns
+DISH_TURN_INTERVALS = {REDTINT: 4,
+                       BLUETINT: 5}
+
 BGCOLOR = DARKBLUE
 TEXTCOLOR = OFFWHITE
 
@@ -40,6 +44,52 @@ MENUMUSIC_FILENAME = 'data\\music\\loooooong circuit.ogg'
 BGMUSIC_FILENAME = 'data\\music\\short circuit background.ogg'
 LEVELS_FILENAME = 'data\\sclevels.data'
 PROFILES_FILENAME = 'scprofiles.data'
+# parsed levels are cached in the levels filename + this
+LEVELS_CACHE_SUFFIX = '.cache'
+# change this whenever parseLevelsFile changes what it returns
+LEVELS_CACHE_VERSION = 2
+# LevelPack keeps its index of the levels file in the filename + this
+LEVELS_INDEX_SUFFIX = '.index'
+# how many parsed levels a LevelPack holds on to
+LEVEL_PACK_CACHE_SIZE = 8
+# how many rendered pieces of text renderText holds on to
+TEXT_CACHE_SIZE = 256
+# message text is written from here on msgBG, and wrapped to this many
+# pixels (2 short of the right edge of its black)
+MSG_TEXT_LEFT = 186
+MSG_TEXT_TOP = 25
+MSG_TEXT_WIDTH = 982
+# the characters a GlyphAtlas renders up front (printable ASCII)
+GLYPH_CHARS = ''.join([chr(i) for i in range(32, 127)])
+
+# threads an AssetLoader decodes image and sound files on
+ASSET_LOADER_THREADS = 4
+
+# IMAGESDICT's images, by key: (filename, or tuple of filenames, useColorKey)
+IMAGE_FILES = {'c':         (('data\\images\\c0.png',
+                              'data\\images\\c1.png',
+                              'data\\images\\c2.png',
+                              'data\\images\\c3.png',
+                              'data\\images\\c4.png',
+                              'data\\images\\c5.png'), False),
+               'dish':      (('data\\images\\dish0.png',
+                              'data\\images\\dish1.png',
+                              'data\\images\\dish2.png',
+                              'data\\images\\dish3.png',
+                              'data\\images\\dish4.png',
+                              'data\\images\\dish5.png'), False),
+               'tile':      ('data\\images\\hex_large.bmp', True),
+               'tile mask': ('data\\images\\hex_large_mask.bmp', True),
+               'wall':      ('data\\images\\wall.bmp', True),
+               'UncGoal':   ('data\\images\\UncGoal.png', False),
+               'CompGoal':  ('data\\images\\CompGoal.png', False),
+               'levelComplete': ('data\\images\\levelcomplete.png', False),
+               'beenDetected':  ('data\\images\\beendetected.png', False),
+               'msgBG':     ('data\\images\\msgBG.png', False)}
+# images that aren't loaded until they're first used
+LAZY_IMAGES = ('levelComplete', 'beenDetected')
+# SOUNDSDICT's sounds, by key
+SOUND_FILES = {'keyStrokes': 'data\\sounds\\keyStrokes.ogg'}
 
 # width and height of the square tile containing a hex
 SIDE_OF_TILE = 40
@@ -52,6 +102,17 @@ LEFT = 3
 DOWNLEFT = 4
 DOWNRIGHT = 5
 
+# renderText's surfaces by (font, text, color, antialias), least recently
+# used first
+TEXTCACHE = collections.OrderedDict()
+# getGlyphAtlas's atlases by (font, color)
+GLYPHATLASES = {}
+# getMessagePanel's last panel, by (message, speaker, width)
+MESSAGEPANELS = {}
+# wrapText's lines by (text, font, width)
+WRAPCACHE = {}
+# the (screen copy, overlay) surfaces Fade draws with, by screen size
+FADESURFS = {}
 
 
 def loadImageFile(filename, useColorKey=False):
@@ -61,7 +122,11 @@ def loadImageFile(filename, useColorKey=False):
     except pygame.error, message:
         print 'Cannot load image:', filename
         terminate()
-    
+    return convertImage(image, useColorKey)
+
+def convertImage(image, useColorKey=False):
+    '''Returns a loaded image converted for the display.  If useColorKey,
+    the color of its top left pixel is transparent.'''
     if useColorKey:
         image = image.convert()
         colorkey = image.get_at((0, 0))
@@ -71,6 +136,150 @@ def loadImageFile(filename, useColorKey=False):
     
     return image
 
+def getImageFilenames(key):
+    '''Returns a tuple of the files of IMAGESDICT[key].'''
+    filenames = IMAGE_FILES[key][0]
+    if isinstance(filenames, tuple):
+        return filenames
+    return (filenames,)
+
+def loadImage(key):
+    '''Loads IMAGESDICT[key] from its IMAGE_FILES, right away.'''
+    (filenames, useColorKey) = IMAGE_FILES[key]
+    if isinstance(filenames, tuple):
+        return tuple([loadImageFile(filename, useColorKey) for filename in filenames])
+    return loadImageFile(filenames, useColorKey)
+
+def loadImagesDict():
+    '''Loads every image the game uses, but for LAZY_IMAGES, which are loaded
+    when they're first used.  Needs the display to be set up.  Returns the
+    dictionary that becomes IMAGESDICT.'''
+    loader = AssetLoader()
+    loader.loadImages()
+    imagesDict = loader.getImagesDict()
+    loader.close()
+    return imagesDict
+
+class ImagesDict(dict):
+    '''The type of IMAGESDICT.  An image of IMAGE_FILES that isn't in it yet
+    (one of LAZY_IMAGES) is loaded the first time it's looked up.'''
+    def __missing__(self, key):
+        if key not in IMAGE_FILES:
+            raise KeyError(key)
+        self[key] = loadImage(key)
+        return self[key]
+
+class AssetLoader:
+    '''Decodes image and sound files on a pool of threads, so that the start
+    screen can be up, and show how far along they are, while they load.
+    Images are converted for the display, which has to be done on the main
+    thread, as they're collected.'''
+    def __init__(self, threads=ASSET_LOADER_THREADS):
+        self.pool = multiprocessing.pool.ThreadPool(threads)
+        # the decoding of each file, by IMAGESDICT or SOUNDSDICT key
+        self.imageJobs = {} # key -> tuple of AsyncResults, one per file
+        self.soundJobs = {} # key -> AsyncResult
+        self.images = {} # the images collected so far, converted
+
+    def loadImages(self, keys=None):
+        '''Starts decoding the IMAGE_FILES of keys, or of all but LAZY_IMAGES.'''
+        if keys == None:
+            keys = [key for key in IMAGE_FILES if key not in LAZY_IMAGES]
+        for key in keys:
+            self.imageJobs[key] = tuple([self.pool.apply_async(pygame.image.load, (filename,))
+                                         for filename in getImageFilenames(key)])
+
+    def loadSounds(self):
+        '''Starts decoding SOUND_FILES.  Needs the mixer to be set up.'''
+        for (key, filename) in SOUND_FILES.items():
+            self.soundJobs[key] = self.pool.apply_async(pygame.mixer.Sound, (filename,))
+
+    def getJobs(self):
+        jobs = list(self.soundJobs.values())
+        for imageJobs in self.imageJobs.values():
+            jobs.extend(imageJobs)
+        return jobs
+
+    def getProgress(self):
+        '''Returns the fraction of the files that are done.'''
+        jobs = self.getJobs()
+        if len(jobs) == 0:
+            return 1.0
+        return float(len([job for job in jobs if job.ready()]))/len(jobs)
+
+    def isDone(self):
+        for job in self.getJobs():
+            if not job.ready():
+                return False
+        return True
+
+    def getImage(self, key):
+        '''Returns IMAGESDICT[key], waiting for its files if they're still
+        being decoded.'''
+        if key not in self.images:
+            images = []
+            for (filename, job) in zip(getImageFilenames(key), self.imageJobs[key]):
+                try:
+                    image = job.get()
+                except pygame.error, message:
+                    print 'Cannot load image:', filename
+                    terminate()
+                images.append(convertImage(image, IMAGE_FILES[key][1]))
+            if isinstance(IMAGE_FILES[key][0], tuple):
+                self.images[key] = tuple(images)
+            else:
+                self.images[key] = images[0]
+        return self.images[key]
+
+    def getImagesDict(self):
+        '''Returns the ImagesDict of the images given to loadImages, waiting
+        for any still being decoded.'''
+        imagesDict = ImagesDict()
+        for key in self.imageJobs:
+            imagesDict[key] = self.getImage(key)
+        # the tints of the dishes, by color; see getTintSurface
+        imagesDict['tints'] = dict((tint, makeTintSurface(imagesDict['tile mask'], tint))
+                                   for tint in DISH_TURN_INTERVALS)
+        return imagesDict
+
+    def getSoundsDict(self):
+        '''Returns SOUNDSDICT, waiting for any sounds still being decoded.'''
+        soundsDict = {}
+        for (key, job) in self.soundJobs.items():
+            try:
+                soundsDict[key] = job.get()
+            except pygame.error, message:
+                print 'Cannot load sound:', SOUND_FILES[key]
+                terminate()
+        return soundsDict
+
+    def close(self):
+        '''Lets the threads go once they're done, without waiting for them.'''
+        self.pool.close()
+
+def makeTintSurface(tileMask, tint):
+    '''Returns a tile-shaped surface of the tint (r, g, b, alpha), to be drawn
+    over a detected tile.'''
+    (r, g, b, a) = tint
+    tintSurf = tileMask.copy()
+    overlay = pygame.Surface((SIDE_OF_TILE, SIDE_OF_TILE))
+    overlay.fill((r, g, b))
+    overlay.set_alpha(a)
+    tintSurf.blit(overlay, (0,0))
+    colorkey = tintSurf.get_at((0,0))
+    tintSurf.set_colorkey(colorkey, RLEACCEL)
+    tintSurf.set_alpha(a)
+    return tintSurf
+
+def getTintSurface(tint):
+    '''Returns the surface drawn over tiles detected by a dish of the tint.
+    Tints that weren't made with IMAGESDICT (new kinds of dish) are made the
+    first time and kept.'''
+    tints = IMAGESDICT.setdefault('tints', {})
+    if tint not in tints:
+        tints[tint] = makeTintSurface(IMAGESDICT['tile mask'], tint)
+    return tints[tint]
+
 class Button:
     def __init__(self, rect, text='', textColor=OFFWHITE, color=BLUE,
                  highlightColor=RED, clickedColor=BLACK):
@@ -104,13 +313,16 @@ class Button:
 
     def setFont(self, font):
         self.font = font
+        self.setupText()
 
     def setText(self, text):
+        if text == self.text:
+            return
         self.text = text
         self.setupText()
 
     def setupText(self):
-        self.textSurf = self.font.render(self.text, True, self.textColor)
+        self.textSurf = renderText(self.font, self.text, self.textColor)
         self.textRect = self.textSurf.get_rect()
         self.update(None, False)
 
@@ -262,6 +474,328 @@ def getTopLeft(address):
     return (SIDE_OF_TILE*x + SIDE_OF_TILE/2*(y%2),
             SIDE_OF_TILE*3/4*y)
 
+def getZoneSpan(righthandDir, dy, parity):
+    '''Returns the (mindx, maxdx) span of the row dy rows below the home hex of
+    a half-cone whose right-hand edge is in righthandDir.  parity is the home
+    hex's y % 2.  An end of None means the row runs on to that edge of the
+    board, and None instead of a span means the row is not in the half-cone.'''
+    # (n + parity)//2 is how far a cone edge has drifted sideways after n rows
+    up = (-dy + parity)//2
+    down = (dy + parity)//2
+    if righthandDir == RIGHT:
+        if dy <= 0:
+            return (up, None)
+    elif righthandDir == UPRIGHT:
+        return (down, up)
+    elif righthandDir == UPLEFT:
+        if dy <= 0:
+            return (None, down)
+    elif righthandDir == LEFT:
+        if dy >= 0:
+            return (None, up)
+    elif righthandDir == DOWNLEFT:
+        return (up, down)
+    elif righthandDir == DOWNRIGHT:
+        if dy >= 0:
+            return (down, None)
+    return None
+
+def getZoneRows(width, height, address, righthandDir):
+    '''Returns a list of (y, leftx, rightx) for each row of a width x height
+    board that the half-cone (see getZoneSpan) at address reaches into.'''
+    (a, b) = address
+    rows = []
+    for k in range(height):
+        span = getZoneSpan(righthandDir, k - b, b % 2)
+        if span == None:
+            continue
+        (mindx, maxdx) = span
+        if mindx == None:
+            left = 0
+        else:
+            left = max(0, a + mindx)
+        if maxdx == None:
+            right = width - 1
+        else:
+            right = min(width - 1, a + maxdx)
+        if left <= right:
+            rows.append((k, left, right))
+    return rows
+
+def getAddressesInZone(width, height, address, righthandDir):
+    '''Returns a list of the addresses on a width x height board in the
+    half-cone whose home hex is address and whose right-hand edge is in
+    righthandDir.  The home address is included.'''
+    addresses = []
+    for (k, left, right) in getZoneRows(width, height, address, righthandDir):
+        for h in range(left, right + 1):
+            addresses.append((h, k))
+    return addresses
+
+class Bitboard:
+    '''Walls, goals, half-cones and detection of a board as integer bitmasks.
+    Bit number y*width + x stands for the hex at (x, y).  Needs no pygame.'''
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.walls = 0
+        self.goals = 0
+        # zoneTable[(address, righthandDir)] is a mask, filled in on first use
+        # so that huge boards don't pay for cones nobody looks at
+        self.zoneTable = {}
+
+    def getWidth(self):
+        return self.width
+
+    def getHeight(self):
+        return self.height
+
+    def getBit(self, address):
+        (x, y) = address
+        return 1 << (y*self.width + x)
+
+    def getMask(self, addresses):
+        '''Returns the mask with the bits of all the addresses set.'''
+        mask = 0
+        for address in addresses:
+            mask |= self.getBit(address)
+        return mask
+
+    def getAddresses(self, mask):
+        '''Returns a list of the addresses whose bits are set in mask.'''
+        # the binary digits, lowest bit first, are read a row at a time and
+        # a run of set bits at a time; taking bits off the mask one at a time
+        # would copy the whole mask for each of them
+        bits = bin(mask)[:1:-1]
+        addresses = []
+        for y in range((len(bits) + self.width - 1) // self.width):
+            row = bits[y*self.width:(y + 1)*self.width]
+            start = row.find('1')
+            while start != -1:
+                end = row.find('0', start)
+                if end == -1:
+                    end = len(row)
+                addresses.extend([(x, y) for x in range(start, end)])
+                start = row.find('1', end)
+        return addresses
+
+    def isAddressOutOfRange(self, address):
+        (x, y) = address
+        return x < 0 or x > self.width - 1 or y < 0 or y > self.height - 1
+
+    def buildWallAt(self, address):
+        self.walls |= self.getBit(address)
+
+    def isWallAt(self, address):
+        return self.walls & self.getBit(address) != 0
+
+    def getWalls(self):
+        return self.walls
+
+    def addGoalAt(self, address):
+        self.goals |= self.getBit(address)
+
+    def removeGoalAt(self, address):
+        self.goals &= ~self.getBit(address)
+
+    def isGoalAt(self, address):
+        return self.goals & self.getBit(address) != 0
+
+    def getGoals(self):
+        return self.goals
+
+    def getZone(self, address, righthandDir):
+        '''Returns the mask of the half-cone whose right-hand edge is in
+        righthandDir.  Address is included.'''
+        key = (address, righthandDir)
+        if key not in self.zoneTable:
+            mask = 0
+            for (k, left, right) in getZoneRows(self.width, self.height, address, righthandDir):
+                mask |= ((1 << (right - left + 1)) - 1) << (k*self.width + left)
+            self.zoneTable[key] = mask
+        return self.zoneTable[key]
+
+    def getDetectedMask(self, dishAddress, mainDir):
+        '''Returns the mask of the hexes scanned by a dish at dishAddress facing
+        mainDir.  Follows the same rules as Gameboard.getDetectedTiles always has.'''
+        (x, y) = dishAddress
+        (dx, dy) = getdxdy(dishAddress, mainDir)
+        startAddress = (x + dx, y + dy)
+        if self.isAddressOutOfRange(startAddress) or self.isWallAt(startAddress):
+            return 0
+        offDir = (mainDir - 1) % 6
+        righthand = self.getZone(startAddress, offDir)
+        lefthand = self.getZone(startAddress, mainDir)
+        righthandWalls = righthand & self.walls
+        lefthandWalls = lefthand & self.walls
+
+        detected = righthand | lefthand
+        # remove half-cones because of walls off the center line
+        for wall in self.getAddresses(righthandWalls & ~lefthandWalls):
+            detected &= ~self.getZone(wall, offDir)
+        for wall in self.getAddresses(lefthandWalls & ~righthandWalls):
+            detected &= ~self.getZone(wall, mainDir)
+        # remove center line beyond walls
+        for wall in self.getAddresses(righthandWalls & lefthandWalls):
+            detected &= ~(self.getZone(wall, mainDir) & self.getZone(wall, offDir))
+        return detected
+
+def getDishFacing(tint, startFacing, turn):
+    '''Returns the facing of a dish after turn turns of the level.'''
+    return (startFacing + turn // DISH_TURN_INTERVALS[tint]) % 6
+
+def getDetectionPeriod(dishes):
+    '''Returns the number of turns after which all the dishes are back to
+    their starting facings.  dishes is a list of (tint, address, facing).'''
+    period = 1
+    for (tint, address, facing) in dishes:
+        revolution = 6*DISH_TURN_INTERVALS[tint]
+        period = period*revolution // fractions.gcd(period, revolution)
+    return period
+
+class DetectionSchedule:
+    '''Every hex detected by any of a level's dishes, for every turn.
+    Dish facings only depend on the turn number, so the pattern repeats
+    every getPeriod() turns (at most 120) and is worked out once per level.
+    Assumes the walls don't change during the level.'''
+    def __init__(self, levelDict):
+        self.bitboard = Bitboard(levelDict['width'], levelDict['height'])
+        for address in levelDict['wallAddresses']:
+            self.bitboard.buildWallAt(address)
+        dishes = levelDict['dishes']
+        self.period = getDetectionPeriod(dishes)
+
+        # each dish has only six facings, so do the geometry for those once
+        detectedByFacing = {}
+        # masks[turn % period] is the union of detected hexes on that turn
+        self.masks = []
+        for turn in range(self.period):
+            detected = 0
+            for (tint, address, startFacing) in dishes:
+                key = (address, getDishFacing(tint, startFacing, turn))
+                if key not in detectedByFacing:
+                    detectedByFacing[key] = self.bitboard.getDetectedMask(*key)
+                detected |= detectedByFacing[key]
+            self.masks.append(detected)
+
+    def getBitboard(self):
+        return self.bitboard
+
+    def getPeriod(self):
+        return self.period
+
+    def getDetectedMask(self, turn):
+        return self.masks[turn % self.period]
+
+    def isDetected(self, address, turn):
+        '''Returns boolean'''
+        return self.masks[turn % self.period] & self.bitboard.getBit(address) != 0
+
+def getMoveTable(board):
+    '''Returns a dictionary mapping each address on the board to a dictionary
+    of direction -> address, for each move isMovePossible allows from there.
+    board is a Gameboard or a Bitboard.'''
+    moveTable = {}
+    for x in range(board.getWidth()):
+        for y in range(board.getHeight()):
+            moveTable[(x, y)] = {}
+            for direction in (RIGHT, UPRIGHT, UPLEFT, LEFT, DOWNLEFT, DOWNRIGHT):
+                (dx, dy) = getdxdy((x, y), direction)
+                if isMovePossible(board, (x + dx, y + dy)):
+                    moveTable[(x, y)][direction] = (x + dx, y + dy)
+    return moveTable
+
+class GameState:
+    '''The rules of a level, with no drawing: the player's address and facing,
+    the turn counter, the dish facings, the goals left and whether the player
+    has been detected.  Needs no pygame, so it can be stepped as fast as the
+    rules allow by tests, solvers and bots; runLevel draws from one.'''
+    def __init__(self, levelDict, schedule=None):
+        '''schedule is the level's DetectionSchedule, built here if not given.'''
+        self.levelDict = levelDict
+        if schedule == None:
+            schedule = DetectionSchedule(levelDict)
+        self.schedule = schedule
+        self.bitboard = schedule.getBitboard()
+        self.moveTable = getMoveTable(self.bitboard)
+        self.reset()
+
+    def reset(self):
+        '''Puts everything back to the start of the level.'''
+        self.playerAddress = self.levelDict['playerAddress']
+        self.playerFacing = RIGHT
+        self.turn = 0
+        self.goalsLeft = self.bitboard.getMask(self.levelDict['goalAddresses'])
+        self.collectedGoal = False
+        self.detected = self.schedule.isDetected(self.playerAddress, 0)
+
+    def step(self, direction):
+        '''Moves the player one hex in direction, if possible, and plays out
+        the turn.  Returns True if it happened, False if not.  The player turns
+        to face direction even if the move isn't possible.
+        Nothing moves once the player is detected or the goals are done.'''
+        self.collectedGoal = False
+        if self.detected or self.goalsLeft == 0:
+            return False
+        if direction not in (RIGHT, UPRIGHT, UPLEFT, LEFT, DOWNLEFT, DOWNRIGHT):
+            return False
+        self.playerFacing = direction
+        newAddress = self.moveTable[self.playerAddress].get(direction)
+        if newAddress == None:
+            return False
+        self.playerAddress = newAddress
+
+        # increment the turn counter (the dishes turn with it)
+        self.turn += 1
+
+        goalBit = self.bitboard.getBit(newAddress)
+        if self.goalsLeft & goalBit:
+            self.goalsLeft &= ~goalBit
+            self.collectedGoal = True
+        if self.schedule.isDetected(newAddress, self.turn):
+            self.detected = True
+        return True
+
+    def getLevelDict(self):
+        return self.levelDict
+
+    def getSchedule(self):
+        return self.schedule
+
+    def getPlayerAddress(self):
+        return self.playerAddress
+
+    def getPlayerFacing(self):
+        return self.playerFacing
+
+    def getTurn(self):
+        return self.turn
+
+    def getDishFacings(self):
+        '''Returns a list of facings, in the order of levelDict['dishes'].'''
+        return [getDishFacing(tint, facing, self.turn)
+                for (tint, address, facing) in self.levelDict['dishes']]
+
+    def getGoalsLeft(self):
+        '''Returns a list of the addresses of the goals not yet reached.'''
+        return self.bitboard.getAddresses(self.goalsLeft)
+
+    def hasCollectedGoal(self):
+        '''Returns True if the last step reached a goal.'''
+        return self.collectedGoal
+
+    def isPlayerDetected(self):
+        return self.detected
+
+    def areGoalsAchieved(self):
+        '''True once every goal is reached, even if the player was detected
+        on the last one (being detected wins; see isComplete).'''
+        return self.goalsLeft == 0
+
+    def isComplete(self):
+        '''Returns True if the level has been won.'''
+        return self.goalsLeft == 0 and not self.detected
+
 class Tile:
     def __init__(self, address):
         # address is (x, y) location on gameboard (not pixels)
@@ -316,6 +850,21 @@ class Gameboard:
         # array[x][y] is the tile at (x, y)
         self.array = [[Tile((x, y)) for y in range(self.getHeight())]
                     for x in range(self.getWidth())]
+        self.bitboard = Bitboard(self.getWidth(), self.getHeight())
+        # detectionCache[(dishAddress, facing, wallVersion)] is a list of tiles;
+        # wallVersion goes up whenever a wall is built
+        self.detectionCache = {}
+        self.wallVersion = 0
+        # tintedTiles[tile] is a tuple of the dishes whose tints drawGameboard
+        # last drew on it, in the order they were drawn
+        self.tintedTiles = {}
+        # the board image with the tints of the dishes, as they faced when
+        # it was made; see getCoverageLayer.  imageVersion goes up whenever
+        # the image is set
+        self.coverageKey = None
+        self.coverageLayer = None
+        self.coverage = None
+        self.imageVersion = 0
         self.surface = pygame.Surface(((self.getWidth() + .5)*SIDE_OF_TILE,
             (.75*self.getHeight() + .25)*SIDE_OF_TILE))
         self.getSurface().fill(BGCOLOR)
@@ -339,9 +888,19 @@ class Gameboard:
     
     def setImage(self, newImage):
         self.image = newImage
+        self.imageVersion += 1
     
     def getArray(self):
         return self.array
+
+    def getBitboard(self):
+        return self.bitboard
+
+    def getTintedTiles(self):
+        return self.tintedTiles
+
+    def setTintedTiles(self, newTintedTiles):
+        self.tintedTiles = newTintedTiles
     
     def getWidth(self):
         return self.width
@@ -373,6 +932,9 @@ class Gameboard:
     def buildWallAt(self, address):
         (x, y) = address
         self.getArray()[x][y].setWall(True)
+        self.getBitboard().buildWallAt(address)
+        self.wallVersion += 1
+        self.detectionCache = {}
 
     def isWallAt(self, address):
         (x, y) = address
@@ -381,11 +943,49 @@ class Gameboard:
     def addGoalAt(self, address):
         (x, y) = address
         self.getArray()[x][y].makeGoal()
+        self.getBitboard().addGoalAt(address)
 
     def markGoalAt(self, address):
         # doesn't check to see if there was even a goal there
         (x, y) = address
         self.getArray()[x][y].markCompletedGoal()
+        self.getBitboard().removeGoalAt(address)
+        self.redrawTiles([self.getArray()[x][y]])
+
+    def resetGoals(self, goalAddresses):
+        '''Puts back the goals that were marked completed, for playing the
+        level again on the same board.'''
+        changedTiles = []
+        for address in goalAddresses:
+            if not self.getBitboard().isGoalAt(address):
+                self.addGoalAt(address)
+                (x, y) = address
+                changedTiles.append(self.getArray()[x][y])
+        self.redrawTiles(changedTiles)
+
+    def redrawTiles(self, tiles):
+        '''Draws tiles whose images changed again on the saved image, and on
+        the coverage layer with their tints, in place.  Nothing outside the
+        tiles' rects is touched.'''
+        image = self.getImage()
+        for tile in tiles:
+            rect = tile.getRect()
+            (x, y) = tile.getAddress()
+            # the neighbors overlap the tile's rect; draw them in the same
+            # order as blitTiles
+            image.set_clip(rect)
+            for h in range(max(x - 1, 0), min(x + 2, self.getWidth())):
+                for k in range(max(y - 1, 0), min(y + 2, self.getHeight())):
+                    neighbor = self.getArray()[h][k]
+                    image.blit(neighbor.getImage(), neighbor.getRect())
+            image.set_clip(None)
+            if self.coverage != None:
+                (layer, tintBlits, tintedTiles) = self.coverage
+                layer.set_clip(rect)
+                layer.blit(image, (0,0))
+                layer.blits([(tintSurf, tintRect) for (tintSurf, tintRect) in tintBlits
+                             if tintRect.colliderect(rect)], False)
+                layer.set_clip(None)
 
     def isAddressOutOfRange(self, address):
         (x, y) = address
@@ -398,77 +998,63 @@ class Gameboard:
     def getTilesInZone(self, hometile, righthandDir):
         '''Returns a list of tiles in a half-cone whose right-hand edge is in
         righthandDir, and a list of those tiles which have walls.
-        Hometile is included (possibly in both).'''
-        (a, b) = hometile.getAddress()
+        Hometile is included (possibly in both).  Only the rows the half-cone
+        reaches into are looked at, not the whole board.'''
+        array = self.getArray()
         tiles = []
-        tilesWithWalls = []
-        for h in range(self.getWidth()):
-            # for computing
-            # k - b >= line1 are hexes below or on UPRIGHT line
-            # k - b <= -line1 are hexes above or on DOWNRIGHT line
-            line1 = -2*(h - a + (b+1)%2) + .1*((b+1)%2)
-            # k - b >= line2 are hexes below or on UPLEFT line
-            # k - b <= -line2 are hexes above or on DOWNLEFT line
-            line2 = 2*(h - a - b%2) + .1*(b%2)
-            for k in range(self.getHeight()):
-                tileInZone = False
-                if righthandDir == RIGHT and line1 <= k - b <= 0:
-                    tileInZone = True
-                elif righthandDir == UPRIGHT and k - b <= -line2 and k - b <= -line1:
-                    tileInZone = True
-                elif righthandDir == UPLEFT and k - b <= 0 and k - b >= line2:
-                    tileInZone = True
-                elif righthandDir == LEFT and 0 <= k - b <= -line2:
-                    tileInZone = True
-                elif righthandDir == DOWNLEFT and k - b >= line1 and k - b >= line2:
-                    tileInZone = True
-                elif righthandDir == DOWNRIGHT and k - b >= 0 and k - b <= -line1:
-                    tileInZone = True
-                
-                if tileInZone:
-                    tile = self.getArray()[h][k]
-                    tiles.append(tile)
-                    if tile.hasWall():
-                        tilesWithWalls.append(tile)
+        for (k, left, right) in getZoneRows(self.getWidth(), self.getHeight(),
+                                            hometile.getAddress(), righthandDir):
+            for h in range(left, right + 1):
+                tiles.append(array[h][k])
+        tilesWithWalls = [tile for tile in tiles if tile.hasWall()]
         return tiles, tilesWithWalls
 
     def getDetectedTiles(self, dish):
-        '''Returns a list of those tiles being scanned by the dish.'''
-        (x, y) = dish.getAddress()
-        mainDir = dish.getFacing()
-        (dx, dy) = getdxdy((x, y), mainDir)
-        if self.isAddressOutOfRange((x + dx, y + dy)) or self.isWallAt((x + dx, y + dy)):
-            return []
-        else:
-            startTile = self.getArray()[x + dx][y + dy]
-            offDir = (mainDir - 1) % 6
-            righthandTiles, righthandWalls = self.getTilesInZone(startTile, offDir)
-            lefthandTiles, lefthandWalls = self.getTilesInZone(startTile, mainDir)
-
-            tiles = list(set(righthandTiles) | set(lefthandTiles))
-
-            blockingWalls = []
-            for rightWall in list(set(righthandWalls) - set(lefthandWalls)):
-                blockingWalls.append((rightWall, offDir))
-            for leftWall in list(set(lefthandWalls) - set(righthandWalls)):
-                blockingWalls.append((leftWall, mainDir))
-            # remove half-cones because of walls off the center line
-            for (tileWithWall, righthandDir) in blockingWalls:
-                blockedTiles = self.getBlockedTiles(tileWithWall, righthandDir)
-                tiles = list(set(tiles) - set(blockedTiles)) # remove blocked tiles from those detected
-
-            # remove center line beyond walls
-            for centerwall in list(set(righthandWalls) & set(lefthandWalls)):
-                blockedTiles = list(set(self.getBlockedTiles(centerwall, mainDir)) \
-                                    & set(self.getBlockedTiles(centerwall, offDir)))
-                tiles = list(set(tiles) - set(blockedTiles)) # remove blocked tiles from those detected
-                    
-            return tiles
-
-    def getBlockedTiles(self, tileWithWall, righthandDir):
-        '''Returns a list of tiles blocked.'''
-        blockedTiles, wallsInZone = self.getTilesInZone(tileWithWall, righthandDir)
-        return blockedTiles
+        '''Returns a list of those tiles being scanned by the dish.
+        Only recomputed when the dish has moved or turned or a wall was built.'''
+        key = (dish.getAddress(), dish.getFacing(), self.wallVersion)
+        if key not in self.detectionCache:
+            detected = self.getBitboard().getDetectedMask(dish.getAddress(), dish.getFacing())
+            self.detectionCache[key] = [self.getArray()[x][y] for (x, y)
+                                        in self.getBitboard().getAddresses(detected)]
+        return self.detectionCache[key]
+
+    def getCoverageLayer(self, dishes):
+        '''Returns (layer, tintBlits, tintedTiles): the board image with every
+        tile detected by the dishes tinted, the (tint surface, rect) pairs
+        drawn on it in order, and a dict of the tuple of dishes tinting each
+        tile.  Only remade when a dish has turned or moved, a wall was built
+        or the image changed, so once a turn at most.'''
+        key = (tuple([(dish, dish.getAddress(), dish.getFacing()) for dish in dishes]),
+               self.wallVersion, self.imageVersion)
+        if key != self.coverageKey:
+            tintBlits = []
+            tintedTiles = {}
+            for dish in dishes:
+                tintSurf = getTintSurface(dish.getTint())
+                for tile in self.getDetectedTiles(dish):
+                    tintBlits.append((tintSurf, tile.getRect()))
+                    tintedTiles[tile] = tintedTiles.get(tile, ()) + (dish,)
+            if self.coverageLayer == None:
+                self.coverageLayer = self.getImage().copy()
+            else:
+                self.coverageLayer.blit(self.getImage(), (0,0))
+            self.coverageLayer.blits(tintBlits, False)
+            self.coverageKey = key
+            self.coverage = (self.coverageLayer, tintBlits, tintedTiles)
+        return self.coverage
+
+def isMovePossible(board, address):
+    '''Returns True if a sprite may step onto the hex at address.
+    board is a Gameboard or a Bitboard.'''
+    if board.isAddressOutOfRange(address):
+        # move is not possible, sprite at edge
+        return False
+    elif board.isWallAt(address):
+        # move is not possible, wall in way
+        return False
+    else:
+        return True
 
 class GameSprite(pygame.sprite.Sprite):
     def __init__(self, images, address, facing=RIGHT):
@@ -512,15 +1098,11 @@ class GameSprite(pygame.sprite.Sprite):
         no hex on the board at the incremented address (sprite at edge).'''
         (x, y) = self.getAddress()
         newAddress = (x + dx, y + dy)
-        if gameboard.isAddressOutOfRange(newAddress):
-            # move is not possible, sprite at edge
-            return False
-        elif gameboard.isWallAt(newAddress):
-            # move is not possible, wall in way
-            return False
-        else:
+        if isMovePossible(gameboard, newAddress):
             self.setAddress(newAddress)
             return True
+        else:
+            return False
 
     def update(self):
         self.getRect().topleft = getTopLeft(self.getAddress())
@@ -549,6 +1131,7 @@ class DishSprite(GameSprite):
 def main():
     global FPSCLOCK, DISPLAYSURF, TITLEFONT, BIGFONT, BASICFONT, MSGFONT, IMAGESDICT, SOUNDSDICT
 
+    startTime = time.time()
     pygame.init()
     FPSCLOCK = pygame.time.Clock()
     DISPLAYSURF = pygame.display.set_mode((WINWIDTH, WINHEIGHT))
@@ -561,44 +1144,32 @@ def main():
     BASICFONT = pygame.font.Font('data\\fonts\\razerregular.ttf', 16)
     MSGFONT = pygame.font.Font('data\\fonts\\dos.ttf', 24)
 
-    # Global images dictionary
-    IMAGESDICT = {'c':      (loadImageFile('data\\images\\c0.png'),
-                             loadImageFile('data\\images\\c1.png'),
-                             loadImageFile('data\\images\\c2.png'),
-                             loadImageFile('data\\images\\c3.png'),
-                             loadImageFile('data\\images\\c4.png'),
-                             loadImageFile('data\\images\\c5.png')),
-                  'dish':   (loadImageFile('data\\images\\dish0.png'),
-                             loadImageFile('data\\images\\dish1.png'),
-                             loadImageFile('data\\images\\dish2.png'),
-                             loadImageFile('data\\images\\dish3.png'),
-                             loadImageFile('data\\images\\dish4.png'),
-                             loadImageFile('data\\images\\dish5.png')),
-                  'tile':   loadImageFile('data\\images\\hex_large.bmp', True),
-                  'tile mask': loadImageFile('data\\images\\hex_large_mask.bmp', True),
-                  'wall':   loadImageFile('data\\images\\wall.bmp', True),
-                  'UncGoal':    loadImageFile('data\\images\\UncGoal.png'),
-                  'CompGoal':   loadImageFile('data\\images\\CompGoal.png'),
-                  'levelComplete':  loadImageFile('data\\images\\levelcomplete.png'),
-                  'beenDetected':   loadImageFile('data\\images\\beendetected.png'),
-                  'msgBG':  loadImageFile('data\\images\\msgBG.png')}
+    # the images and sounds load behind the start screen
+    loader = AssetLoader()
+    loader.loadImages()
+    loader.loadSounds()
 
-    # Global sounds dictionary
-    SOUNDSDICT = {'keyStrokes': pygame.mixer.Sound('data\\sounds\\keyStrokes.ogg')}
-
-    levels = readLevelsFile(LEVELS_FILENAME)
+    levels = LevelPack(LEVELS_FILENAME)
     numberOfLevels = len(levels)
     assert numberOfLevels > 0, 'No levels found in %s.' % (LEVELS_FILENAME)
 
-    profiles = readProfilesFile(PROFILES_FILENAME)
-
     # startscreen
     pygame.mixer.music.load(MENUMUSIC_FILENAME)
     pygame.mixer.music.play(-1, 0.0)
-    showStartScreen()
+    showStartScreen(loader, startTime)
 
-    # transition
-    fadeToColor(BLACK, 500)
+    # Global images dictionary
+    IMAGESDICT = loader.getImagesDict()
+
+    # Global sounds dictionary
+    SOUNDSDICT = loader.getSoundsDict()
+    loader.close()
+
+    # transition, reading the profiles while the screen fades
+    fade = Fade(BLACK, 500)
+    fade.update()
+    profiles = readProfilesFile(PROFILES_FILENAME)
+    fade.finish()
 
     # initial profile select
     profileSelectResult = 'changeProf'
@@ -622,7 +1193,10 @@ def main():
         # transition
         fadetime = 1000 # milliseconds
         pygame.mixer.music.fadeout(fadetime)
-        fadeToColor(BLACK, fadetime)
+        fade = Fade(BLACK, fadetime)
+        fade.update()
+        levels.getSchedule(currentLevelIndex) # parsed and kept while the screen fades
+        fade.finish()
         
         pygame.mixer.music.load(BGMUSIC_FILENAME)
         pygame.mixer.music.play(-1, 0.0)
@@ -630,7 +1204,7 @@ def main():
         # leveling loop -- breaking this loop will go up to level selection above
         leveling = True
         while leveling:
-            result = runLevel(levels, currentLevelIndex)
+            result = runLevel(levels, currentLevelIndex, levels.getSchedule(currentLevelIndex))
             if result == 'complete':
                 # record the completion
                 newBlock = profiles[currentProfileIndex].updateProfile(currentLevelIndex)
@@ -643,8 +1217,6 @@ def main():
                     leveling = False # return to level select
             elif result == 'levelSelect':
                 leveling = False # return to level select
-            elif result == 'reset':
-                pass
 
         # transition
         fadetime = 500 # milliseconds
@@ -653,34 +1225,52 @@ def main():
         pygame.mixer.music.load(MENUMUSIC_FILENAME)
         pygame.mixer.music.play(-1, 0.0)
 
-def runLevel(levels, levelNum):
-    '''Returns 'reset' or 'complete' based on status.'''
-    levelDict = copy.deepcopy(levels[levelNum])
-
-    gameboard = Gameboard(levelDict['width'], levelDict['height'],
-                          (int((WINWIDTH - (levelDict['width'] + .5)*SIDE_OF_TILE)/2),
-                           WINHEIGHT - (.75*levelDict['height'] + .25)*SIDE_OF_TILE))
-    for address in levelDict['wallAddresses']:
-        gameboard.buildWallAt(address)
-    for address in levelDict['goalAddresses']:
-        gameboard.addGoalAt(address)
-    gameboard.blitTiles()
-    gameboard.saveImage()
+def verifyLevels(filename=LEVELS_FILENAME, processes=None):
+    '''Solves every level in the level file, spread over a pool of worker
+    processes (one per core unless processes is given), and prints whether
+    each can be solved, in how few turns and how long it took.
+    Doesn't open a display.  Returns True if every level can be solved.'''
+    startTime = time.time()
+    levels = readLevelsFile(filename)
+    pool = multiprocessing.Pool(processes)
+    solvableCount = 0
+    try:
+        for levelNum, solution in enumerate(pool.imap(solveLevel, levels)):
+            if solution['solvable']:
+                solvableCount += 1
+                print 'Level %s: solved in %s turns (%.3f s)' % (levelNum + 1, solution['turns'], solution['solveTime'])
+            else:
+                print 'Level %s: CANNOT BE SOLVED (%.3f s)' % (levelNum + 1, solution['solveTime'])
+    finally:
+        pool.close()
+        pool.join()
+    print '%s of %s levels in %s can be solved (%.2f s)' % (solvableCount, len(levels), filename, time.time() - startTime)
+    return solvableCount == len(levels)
+
+def runLevel(levels, levelNum, schedule=None):
+    '''Returns 'levelSelect' or 'complete' based on status.  Being detected
+    or pressing backspace starts the level over on the same board.
+    schedule is the level's DetectionSchedule, built here if not given.'''
+    levelDict = levels[levelNum]
+    state = GameState(levelDict, schedule)
+    gameboard = buildGameboard(levelDict)
 
     player = PlayerSprite(levelDict['playerAddress'])
     movingSprites = pygame.sprite.Group(player)
     
-    dishSprites = pygame.sprite.Group()
-    for tint, address, facing in levelDict['dishes']:
-        dishSprites.add(DishSprite(tint, address, facing))
+    # in the same order as the state's dish facings
+    dishList = [DishSprite(tint, address, facing) for (tint, address, facing) in levelDict['dishes']]
+    dishSprites = pygame.sprite.Group(*dishList)
 
     levelMessages = levelDict['messages']
+    restart = True
 
-    gameState = {'turnCounter': 0,
-                 'nextMessage': 0}
-    goalsAchieved = False
-    playerDetected = False
-    messageShown = False
+    # what is on the screen, so that each frame only draws what changed
+    drawnBoardLook = None # (player address, player facing, turn)
+    drawnTurnText = None
+    drawnButtonLook = None # (mouse on, clicked) of the level select button
+    turnRect = None
+    msgRect = None
 
     navButtons = ButtonGroup([])
     levelSelectRect = pygame.Rect(WINWIDTH - 180, WINHEIGHT - 40, 165, 30)
@@ -690,8 +1280,18 @@ def runLevel(levels, levelNum):
 
     # main game loop
     while True:
+        if restart:
+            # a new attempt; the level itself is never changed
+            state.reset()
+            gameboard.resetGoals(levelDict['goalAddresses'])
+            nextMessage = 0
+            goalsAchieved = False
+            playerDetected = False
+            messageShown = False
+            restart = False
+            drawnSurf = None # the display surface last drawn on
+
         # reset variables
-        detectionColor = WHITE
         playerMoveTo = None
         keyPressed = False
         mouseClicked = False
@@ -704,6 +1304,8 @@ def runLevel(levels, levelNum):
             if event.type == MOUSEBUTTONUP:
                 mousePoint = event.pos
                 mouseClicked = True
+            if event.type == VIDEOEXPOSE:
+                drawnSurf = None # the window has to be drawn again
             if event.type == KEYDOWN:
                 keyPressed = True
                 if not playerDetected and not goalsAchieved: # don't move if level's over
@@ -720,112 +1322,128 @@ def runLevel(levels, levelNum):
                     elif event.key in (K_KP3, K_c): # move down right
                         playerMoveTo = DOWNRIGHT
                     elif event.key == K_BACKSPACE:
-                        return 'reset'
+                        restart = True
                     elif event.key == K_l:
                         return 'levelSelect'
 
         if playerMoveTo != None:
-            moved = makeMove(gameboard, player, playerMoveTo)
-
-            if moved:
-                # increment the turn counter
-                gameState['turnCounter'] += 1
-
-                for dish in dishSprites:
-                    if gameState['turnCounter'] % 4 == 0 \
-                       and dish.getTint() == REDTINT:
-                        dish.setFacing((dish.getFacing() + 1) % 6)
-                    elif gameState['turnCounter'] % 5 == 0 \
-                         and dish.getTint() == BLUETINT:
-                        dish.setFacing((dish.getFacing() + 1) % 6)
-
-                if player.getAddress() in levelDict['goalAddresses']:
-                    levelDict['goalAddresses'].remove(player.getAddress())
-                    gameboard.markGoalAt(player.getAddress())
-                    gameboard.blitTiles()
-                    gameboard.saveImage()
-                    if len(levelDict['goalAddresses']) == 0:
-                        goalsAchieved = True
-                        keyPressed = False
-
-
-        DISPLAYSURF.fill(BGCOLOR)
-        gameboard.getSurface().blit(gameboard.getImage(), (0,0))
-
-        # draw sprites to board
-        movingSprites.update()
-        dishSprites.update()
-        movingSprites.clear(gameboard.getSurface(), gameboard.getImage())
-        dishSprites.clear(gameboard.getSurface(), gameboard.getImage())
-        movingSprites.draw(gameboard.getSurface())
-        dishSprites.draw(gameboard.getSurface())
-
-        # find detected tiles and tint them, and if the player is there...
-        for dish in dishSprites:
-            detectedTiles = gameboard.getDetectedTiles(dish)
-            if len(detectedTiles) > 0:
-                (r, g, b, a) = dish.getTint()
-                tintSurf = IMAGESDICT['tile mask'].copy()
-                overlay = pygame.Surface((SIDE_OF_TILE, SIDE_OF_TILE))
-                overlay.fill((r, g, b))
-                overlay.set_alpha(a)
-                tintSurf.blit(overlay, (0,0))
-                colorkey = tintSurf.get_at((0,0))
-                tintSurf.set_colorkey(colorkey, RLEACCEL)
-                tintSurf.set_alpha(a)
-                for tile in detectedTiles:
-                    gameboard.getSurface().blit(tintSurf, tile.getRect())
-                    if player.getAddress() == tile.getAddress():
-                        if not playerDetected:
-                            keyPressed = False
-                        playerDetected = True
-                        detectionColor = (r, g, b)
+            state.step(playerMoveTo)
+            if state.hasCollectedGoal():
+                gameboard.markGoalAt(state.getPlayerAddress())
+
+        # the sprites show what the state says
+        player.setAddress(state.getPlayerAddress())
+        player.setFacing(state.getPlayerFacing())
+        for dish, facing in zip(dishList, state.getDishFacings()):
+            dish.setFacing(facing)
+
+        if state.isPlayerDetected() and not playerDetected:
+            # player has been spotted!
+            keyPressed = False
+            playerDetected = True
+            drawnSurf = None # take any message off the screen
+        if state.areGoalsAchieved() and not goalsAchieved:
+            keyPressed = False
+            goalsAchieved = True
+            drawnSurf = None
+        if messageShown and not playerDetected and not goalsAchieved \
+           and state.getTurn() != levelMessages[nextMessage][0]:
+            # on to the next message
+            nextMessage += 1
+            messageShown = False
+            drawnSurf = None # take this one off the screen
+
+        # Only what changed since the last frame is drawn and sent to the
+        # display; everything is redrawn after a restart, when a message goes
+        # away or the window is switched to or from fullscreen.
+        redrawAll = DISPLAYSURF is not drawnSurf
+        drawnSurf = DISPLAYSURF
+        dirtyRects = []
+        if redrawAll:
+            DISPLAYSURF.fill(BGCOLOR)
+            # draw the level counter
+            levelSurf = renderText(BASICFONT, 'Level: %s' % (levelNum + 1), TEXTCOLOR)
+            levelRect = levelSurf.get_rect()
+            levelRect.bottomleft = (20, WINHEIGHT - 30)
+            DISPLAYSURF.blit(levelSurf, levelRect)
+
+        boardLook = (state.getPlayerAddress(), state.getPlayerFacing(), state.getTurn())
+        boardRects = []
+        if redrawAll or boardLook != drawnBoardLook:
+            boardRects = drawGameboard(gameboard, movingSprites, dishSprites)
+            drawnBoardLook = boardLook
 
         # draw the step counter
-        turnSurf = BASICFONT.render('Turn: %s' % (gameState['turnCounter']), 1, TEXTCOLOR)
-        turnRect = turnSurf.get_rect()
-        turnRect.bottomleft = (20, WINHEIGHT - 10)
-        DISPLAYSURF.blit(turnSurf, turnRect)
-        # draw the level counter
-        levelSurf = BASICFONT.render('Level: %s' % (levelNum + 1), 1, TEXTCOLOR)
-        levelRect = levelSurf.get_rect()
-        levelRect.bottomleft = (20, WINHEIGHT - 30)
-        DISPLAYSURF.blit(levelSurf, levelRect)
+        turnText = 'Turn: %s' % (state.getTurn())
+        if redrawAll or turnText != drawnTurnText:
+            if turnRect != None:
+                DISPLAYSURF.fill(BGCOLOR, turnRect)
+                dirtyRects.append(turnRect)
+            turnSurf = renderText(BASICFONT, turnText, TEXTCOLOR)
+            turnRect = turnSurf.get_rect()
+            turnRect.bottomleft = (20, WINHEIGHT - 10)
+            DISPLAYSURF.blit(turnSurf, turnRect)
+            dirtyRects.append(turnRect)
+            drawnTurnText = turnText
         # draw level select button
         navButtons.update(mousePoint, mouseClicked)
-        navButtons.draw(DISPLAYSURF)
-
-
-        # draw gameboard
-        DISPLAYSURF.blit(gameboard.getSurface(), gameboard.getPos())
+        buttonLook = (levelSelectButton.mouseOn, levelSelectButton.isClicked)
+        if redrawAll or buttonLook != drawnButtonLook:
+            # with room for the highlight around it
+            buttonRect = levelSelectButton.rect.inflate(8, 8)
+            DISPLAYSURF.fill(BGCOLOR, buttonRect)
+            navButtons.draw(DISPLAYSURF)
+            dirtyRects.append(buttonRect)
+            drawnButtonLook = buttonLook
+
+        # draw gameboard, over the counters and button
+        boardRect = pygame.Rect(gameboard.getPos(), gameboard.getSurface().get_size())
+        if redrawAll:
+            DISPLAYSURF.blit(gameboard.getSurface(), boardRect)
+        else:
+            for rect in dirtyRects:
+                if rect.colliderect(boardRect):
+                    boardRects.append(rect.clip(boardRect).move(-boardRect.left, -boardRect.top))
+            for rect in boardRects:
+                DISPLAYSURF.blit(gameboard.getSurface(), rect.move(boardRect.topleft), rect)
+                dirtyRects.append(rect.move(boardRect.topleft))
 
         if playerDetected:
             # player has been spotted!...pause until keypress
             detectSurf = IMAGESDICT['beenDetected']
             detectRect = detectSurf.get_rect()
             detectRect.center = (HALF_WINWIDTH, HALF_WINHEIGHT)
-            DISPLAYSURF.blit(detectSurf, detectRect)
+            if redrawAll or detectRect.collidelist(dirtyRects) != -1:
+                DISPLAYSURF.blit(detectSurf, detectRect)
+                dirtyRects.append(detectRect)
             if keyPressed:
-                return 'reset'
+                restart = True
         elif goalsAchieved:
             # level complete...pause until keypress
             completeSurf = IMAGESDICT['levelComplete']
             completeRect = completeSurf.get_rect()
             completeRect.center = (HALF_WINWIDTH, HALF_WINHEIGHT)
-            DISPLAYSURF.blit(completeSurf, completeRect)
+            if redrawAll or completeRect.collidelist(dirtyRects) != -1:
+                DISPLAYSURF.blit(completeSurf, completeRect)
+                dirtyRects.append(completeRect)
             if keyPressed:
                 return 'complete'
         else:
             # typical day at the park
-            if len(levelMessages) > gameState['nextMessage'] and gameState['turnCounter'] == levelMessages[gameState['nextMessage']][0]:
-                msgIndex = gameState['nextMessage']
+            if len(levelMessages) > nextMessage and state.getTurn() == levelMessages[nextMessage][0]:
+                msgIndex = nextMessage
                 personSpeaking = levelMessages[msgIndex][1]
                 message = levelMessages[msgIndex][2]
-                drawInLevelMessage(message, personSpeaking, not messageShown)
+                if redrawAll or not messageShown or msgRect.collidelist(dirtyRects) != -1:
+                    if messageShown and not redrawAll:
+                        # the panel is see-through in places, so what's under
+                        # it goes back first or the old panel shows through
+                        DISPLAYSURF.fill(BGCOLOR, msgRect)
+                        underRect = msgRect.clip(boardRect)
+                        DISPLAYSURF.blit(gameboard.getSurface(), underRect, underRect.move(-boardRect.left, -boardRect.top))
+                    msgRect = drawInLevelMessage(message, personSpeaking, not messageShown)
+                    dirtyRects.append(msgRect)
                 messageShown = True
-            elif messageShown:
-                gameState['nextMessage'] += 1
-                messageShown = False
 
         # handle level select button
         if mouseClicked and not goalsAchieved:
@@ -834,101 +1452,256 @@ def runLevel(levels, levelNum):
                 return 'levelSelect'
             navClickedButton = None
 
-        pygame.display.update()
-        FPSCLOCK.tick(FPS)
+        if redrawAll:
+            pygame.display.update()
+        elif len(dirtyRects) > 0:
+            pygame.display.update(dirtyRects)
+        if redrawAll or len(dirtyRects) > 0 or restart:
+            FPSCLOCK.tick(FPS)
+        else:
+            # nothing changed, so wait for the player
+            waitForEvent()
 
-def makeMove(gameboard, sprite, direction):
-    '''Moves a sprite on the gameboard in the given direction, if possible.
-    Returns True if it happened, False if not.'''
-    if direction not in (RIGHT, UPRIGHT, UPLEFT, LEFT, DOWNLEFT, DOWNRIGHT):
-        return False
-    address = sprite.getAddress()
-    (dx, dy) = getdxdy(address, direction)
-    sprite.setFacing(direction)
-    return sprite.move(gameboard, dx, dy)
+def buildGameboard(levelDict):
+    '''Returns a Gameboard for the level, placed at the bottom middle of the
+    window, with its walls and goals drawn and saved.'''
+    gameboard = Gameboard(levelDict['width'], levelDict['height'],
+                          (int((WINWIDTH - (levelDict['width'] + .5)*SIDE_OF_TILE)/2),
+                           WINHEIGHT - (.75*levelDict['height'] + .25)*SIDE_OF_TILE))
+    for address in levelDict['wallAddresses']:
+        gameboard.buildWallAt(address)
+    for address in levelDict['goalAddresses']:
+        gameboard.addGoalAt(address)
+    gameboard.blitTiles()
+    gameboard.saveImage()
+    return gameboard
+
+def drawGameboard(gameboard, movingSprites, dishSprites):
+    '''Draws the board, the sprites and the tint of every detected tile
+    onto the gameboard's surface.  Returns a list of the rects of the surface
+    that may look different from the last time it was drawn.'''
+    surface = gameboard.getSurface()
+    sprites = movingSprites.sprites() + dishSprites.sprites()
+    changedRects = [sprite.getRect().copy() for sprite in sprites]
+    movingSprites.update()
+    dishSprites.update()
+    spriteRects = [sprite.getRect() for sprite in sprites]
+    changedRects += spriteRects
+
+    # the board and the tints, made once a turn
+    (layer, tintBlits, tintedTiles) = gameboard.getCoverageLayer(dishSprites.sprites())
+    surface.blit(layer, (0,0))
+
+    # the sprites go under the tints, so redo the board under each of them
+    for rect in spriteRects:
+        surface.set_clip(rect)
+        surface.blit(gameboard.getImage(), (0,0))
+        movingSprites.draw(surface)
+        dishSprites.draw(surface)
+        surface.blits([(tintSurf, tintRect) for (tintSurf, tintRect) in tintBlits
+                       if tintRect.colliderect(rect)], False)
+    surface.set_clip(None)
+
+    # the tiles whose tints changed (or were drawn in another order, which
+    # shows where tiles overlap)
+    oldTintedTiles = gameboard.getTintedTiles()
+    for tile in set(oldTintedTiles) | set(tintedTiles):
+        if oldTintedTiles.get(tile) != tintedTiles.get(tile):
+            changedRects.append(tile.getRect())
+    gameboard.setTintedTiles(tintedTiles)
+    return changedRects
+
+def renderText(font, text, color, antialias=True):
+    '''Returns font.render(text, antialias, color), from the cache if it was
+    rendered lately.  The surface is shared, so don't draw on it.'''
+    key = (font, text, color, antialias)
+    if key in TEXTCACHE:
+        # move it to the most recently used end
+        textSurf = TEXTCACHE.pop(key)
+    else:
+        textSurf = font.render(text, antialias, color)
+    TEXTCACHE[key] = textSurf
+    if len(TEXTCACHE) > TEXT_CACHE_SIZE:
+        TEXTCACHE.popitem(last=False)
+    return textSurf
+
+class GlyphAtlas:
+    '''The characters of a monospaced font, rendered once, so that text can
+    be drawn a character at a time with one blit each.'''
+    def __init__(self, font, color):
+        assert font.size('i') == font.size('W'), 'GlyphAtlas needs a monospaced font.'
+        self.font = font
+        self.color = color
+        (self.glyphWidth, self.height) = font.size(' ')
+        # GLYPH_CHARS in one row, each in its own glyphWidth wide column
+        self.surface = font.render(GLYPH_CHARS, True, color)
+        # characters that aren't in GLYPH_CHARS, rendered when first drawn
+        self.otherGlyphs = {}
+
+    def getGlyphWidth(self):
+        return self.glyphWidth
+
+    def getHeight(self):
+        return self.height
+
+    def getCharRect(self, index, topleft):
+        '''Returns the rect of the index'th character of text drawn at topleft.'''
+        return pygame.Rect(topleft[0] + index*self.glyphWidth, topleft[1], self.glyphWidth, self.height)
+
+    def drawChar(self, surf, char, pos):
+        '''Draws char on surf with its top left corner at pos.'''
+        index = GLYPH_CHARS.find(char)
+        if index != -1:
+            surf.blit(self.surface, pos, (index*self.glyphWidth, 0, self.glyphWidth, self.height))
+        else:
+            if char not in self.otherGlyphs:
+                self.otherGlyphs[char] = self.font.render(char, True, self.color)
+            surf.blit(self.otherGlyphs[char], pos)
+
+def getGlyphAtlas(font, color):
+    '''Returns the GlyphAtlas of font in color, made the first time it's asked for.'''
+    key = (font, color)
+    if key not in GLYPHATLASES:
+        GLYPHATLASES[key] = GlyphAtlas(font, color)
+    return GLYPHATLASES[key]
 
 def drawInLevelMessage(message, personSpeaking, firstTime):
-    '''Displays the message.'''
+    '''Displays the message, typing it out if firstTime.  Returns the rect
+    it was drawn in.'''
+    if not firstTime:
+        msgSurf = getMessagePanel(message, personSpeaking, MSG_TEXT_WIDTH)
+        msgRect = msgSurf.get_rect(midtop = (HALF_WINWIDTH, 2))
+        DISPLAYSURF.blit(msgSurf, msgRect)
+        return msgRect
+
     msgSurf = IMAGESDICT['msgBG'].copy()
     msgRect = msgSurf.get_rect(midtop = (HALF_WINWIDTH, 2))
-
-    if personSpeaking != None:
-        text = personSpeaking + ': ' + message
-    else:
-        text = message
-    lines = breakUpIntoLines(text, 70)
-    topCoord = 25
-    typingSkipped = not firstTime
+    lines = wrapText(getMessageText(message, personSpeaking), MSGFONT, MSG_TEXT_WIDTH)
+    topCoord = MSG_TEXT_TOP
+    typingSkipped = False
     for line in lines:
-        if firstTime and not typingSkipped:
-            height, typingSkipped = typeText(msgSurf, msgRect, line, (186, topCoord), MSGFONT, DOSGREEN)
+        if not typingSkipped:
+            height, typingSkipped = typeText(msgSurf, msgRect, line, (MSG_TEXT_LEFT, topCoord), MSGFONT, DOSGREEN)
         if typingSkipped:
             textSurf = MSGFONT.render(line, True, DOSGREEN)
-            msgSurf.blit(textSurf, (186, topCoord))
+            msgSurf.blit(textSurf, (MSG_TEXT_LEFT, topCoord))
             height = textSurf.get_height()
         topCoord += height
     DISPLAYSURF.blit(msgSurf, msgRect)
+    return msgRect
 
-def breakUpIntoLines(text, maxCharsPerLine):
-    '''Returns a list of strings (the lines).'''
-    lines = ['']
-    currentLineIndex = 0
-    currentWord = ''
-    text += ' '
-    while text != '':
-        currentWord = text[:text.find(' ')]
-        if len(lines[currentLineIndex]) + len(currentWord) + 1 <= maxCharsPerLine:
-            # add word to line
-            if lines[currentLineIndex]:
-                lines[currentLineIndex] += ' '
-            lines[currentLineIndex] += currentWord
+def getMessageText(message, personSpeaking):
+    if personSpeaking != None:
+        return personSpeaking + ': ' + message
+    return message
+
+def getMessagePanel(message, personSpeaking, maxWidth):
+    '''Returns the message background with the message written on it.  Only
+    the last message's panel is kept, so a message that stays up is drawn
+    once.  The surface is shared, so don't draw on it.'''
+    key = (message, personSpeaking, maxWidth)
+    if key not in MESSAGEPANELS:
+        # a different message, so the old panel goes
+        MESSAGEPANELS.clear()
+        msgSurf = IMAGESDICT['msgBG'].copy()
+        topCoord = MSG_TEXT_TOP
+        for line in wrapText(getMessageText(message, personSpeaking), MSGFONT, maxWidth):
+            textSurf = MSGFONT.render(line, True, DOSGREEN)
+            msgSurf.blit(textSurf, (MSG_TEXT_LEFT, topCoord))
+            topCoord += textSurf.get_height()
+        MESSAGEPANELS[key] = msgSurf
+    return MESSAGEPANELS[key]
+
+def wrapText(text, font, maxWidth):
+    '''Returns a list of the lines of text, broken at spaces so that each is
+    at most maxWidth pixels wide in font (unless a single word is wider).
+    The lines of each text are worked out once, so don't change the list.'''
+    key = (text, font, maxWidth)
+    if key in WRAPCACHE:
+        return WRAPCACHE[key]
+    spaceWidth = font.size(' ')[0]
+    lines = []
+    lineWords = []
+    lineWidth = 0
+    for word in text.split(' '):
+        wordWidth = font.size(word)[0]
+        if lineWords and lineWidth + spaceWidth + wordWidth > maxWidth:
+            lines.append(' '.join(lineWords))
+            lineWords = []
+        if lineWords:
+            lineWidth += spaceWidth + wordWidth
+        elif word == '':
+            continue # no line starts with a space
         else:
-            lines.append(currentWord)
-            currentLineIndex += 1
-        text = text[text.find(' ')+1:]
+            lineWidth = wordWidth
+        lineWords.append(word)
+    lines.append(' '.join(lineWords))
+    WRAPCACHE[key] = lines
     return lines
 
 def typeText(surfToTypeOn, surfRect, text, topleft, fontObj, textColor, charsPerSec=32):
     '''Type text on at the given charsPerSec.  Returns height of the text,
     and then a boolean for if they skipped the typing.
 
-    surfToTypeOn - pygame Surface
+    surfToTypeOn - pygame Surface, drawn on DISPLAYSURF at surfRect
     text - string of text
     topleft - coordinates of destination (the topleft corner)
-    fontObj - pygame Font'''
-    displayOldImage = DISPLAYSURF.copy()
+    fontObj - pygame Font, monospaced'''
+    atlas = getGlyphAtlas(fontObj, textColor)
+    # the surface is typed on over the background color
     surfOldImage = surfToTypeOn.copy()
+    surfToTypeOn.fill(BGCOLOR)
+    surfToTypeOn.blit(surfOldImage, (0,0))
+    surfOldImage = surfToTypeOn.copy()
+    screenRect = surfRect.clip(DISPLAYSURF.get_rect())
+    displayOldImage = DISPLAYSURF.subsurface(screenRect).copy()
+    # the rest of the screen may not have been shown yet either
+    DISPLAYSURF.blit(surfToTypeOn, surfRect)
+    pygame.display.update()
+
+    # each frame draws the next character over the cursor, and the cursor
+    # after it, and updates just those two
     curLength = 0
     keySound = SOUNDSDICT['keyStrokes']
     keySound.play()
+    exposed = False
     while curLength <= len(text):
         checkForQuit()
         for event in pygame.event.get():
+            if event.type == VIDEOEXPOSE:
+                # put the surface back now; the caller draws the rest
+                DISPLAYSURF.blit(surfToTypeOn, surfRect)
+                pygame.display.update()
+                exposed = True
             if event.type == KEYDOWN and event.key in (K_SPACE, K_RETURN, K_KP_ENTER):
                 # stop animating, reset display and surf
-                surfToTypeOn.fill(BGCOLOR)
                 surfToTypeOn.blit(surfOldImage, (0,0))
-                DISPLAYSURF.fill(BGCOLOR)
-                DISPLAYSURF.blit(displayOldImage, (0,0))
+                DISPLAYSURF.blit(displayOldImage, screenRect)
                 keySound.stop()
+                if exposed:
+                    pygame.event.post(pygame.event.Event(VIDEOEXPOSE))
                 return 0, True
-        surfToTypeOn.fill(BGCOLOR)
-        surfToTypeOn.blit(surfOldImage, (0,0))
+        charRects = []
+        if curLength > 0:
+            charRect = atlas.getCharRect(curLength - 1, topleft)
+            surfToTypeOn.blit(surfOldImage, charRect, charRect)
+            atlas.drawChar(surfToTypeOn, text[curLength - 1], charRect.topleft)
+            charRects.append(charRect)
         if curLength < len(text):
-            textSoFar = text[:curLength]+'_'
-        else:
-            textSoFar = text
-        textSoFarSurf = fontObj.render(textSoFar, True, textColor)
-        surfToTypeOn.blit(textSoFarSurf, topleft)
-        DISPLAYSURF.fill(BGCOLOR)
-        DISPLAYSURF.blit(displayOldImage, (0,0))
-        DISPLAYSURF.blit(surfToTypeOn, surfRect)
+            cursorRect = atlas.getCharRect(curLength, topleft)
+            atlas.drawChar(surfToTypeOn, '_', cursorRect.topleft)
+            charRects.append(cursorRect)
+        dirtyRects = []
+        for charRect in charRects:
+            dirtyRects.append(DISPLAYSURF.blit(surfToTypeOn, charRect.move(surfRect.topleft), charRect))
         curLength += 1
         
-        pygame.display.update()
+        pygame.display.update(dirtyRects)
         FPSCLOCK.tick(charsPerSec)
     keySound.stop()
-    return textSoFarSurf.get_height(), False
+    if exposed:
+        pygame.event.post(pygame.event.Event(VIDEOEXPOSE))
+    return atlas.getHeight(), False
 
 def getdxdy(address, direction):
     '''Returns (dx, dy) tuple to get to adjacent hex in the given direction.'''
@@ -965,24 +1738,101 @@ def getdxdy(address, direction):
             dx = 1
     return (dx, dy)
 
-def showStartScreen():
+def solveLevel(levelDict, schedule=None):
+    '''Finds the fewest turns that collect every goal without being detected,
+    by a breadth-first search of (player address, goals left, turn % period).
+    There are finitely many such states, so if the search runs out of them
+    the level can't be solved.  Needs no pygame display.
+    schedule is the level's DetectionSchedule, built here if not given.
+    Returns a dictionary:
+    'solvable': boolean
+    'moves': list of directions to press, None if not solvable
+    'turns': len(moves), None if not solvable
+    'nodesExpanded': number of states taken off the search queue
+    'solveTime': seconds taken
+    'nodesPerSecond': nodesExpanded/solveTime'''
+    startTime = time.time()
+    if schedule == None:
+        schedule = DetectionSchedule(levelDict)
+    bitboard = schedule.getBitboard()
+    period = schedule.getPeriod()
+
+    # one bit per goal, so that the goals left are a single int
+    goalBits = {}
+    for address in levelDict['goalAddresses']:
+        goalBits[address] = 1 << len(goalBits)
+
+    # the moves that isMovePossible allows from each hex, as (direction, address)
+    movesFrom = {}
+    for (address, moves) in getMoveTable(bitboard).items():
+        movesFrom[address] = sorted(moves.items())
+
+    startState = (levelDict['playerAddress'], (1 << len(goalBits)) - 1, 0)
+    # transposition table, state -> (previous state, direction moved)
+    cameFrom = {startState: None}
+    queue = collections.deque()
+    if not schedule.isDetected(levelDict['playerAddress'], 0):
+        queue.append(startState)
+    nodesExpanded = 0
+    finalState = None
+    while queue and finalState == None:
+        state = queue.popleft()
+        (address, goalsLeft, phase) = state
+        nodesExpanded += 1
+        nextPhase = (phase + 1) % period
+        for (direction, newAddress) in movesFrom[address]:
+            if schedule.isDetected(newAddress, nextPhase):
+                # even on the last goal, being seen means a reset
+                continue
+            newState = (newAddress, goalsLeft & ~goalBits.get(newAddress, 0), nextPhase)
+            if newState in cameFrom:
+                continue
+            cameFrom[newState] = (state, direction)
+            if newState[1] == 0:
+                finalState = newState
+                break
+            queue.append(newState)
+
+    moves = None
+    if finalState != None:
+        moves = []
+        state = finalState
+        while cameFrom[state] != None:
+            (state, direction) = cameFrom[state]
+            moves.append(direction)
+        moves.reverse()
+
+    solveTime = time.time() - startTime
+    solution = {'solvable':         moves != None,
+                'moves':            moves,
+                'turns':            None,
+                'nodesExpanded':    nodesExpanded,
+                'solveTime':        solveTime,
+                'nodesPerSecond':   nodesExpanded/max(solveTime, 1e-9)}
+    if moves != None:
+        solution['turns'] = len(moves)
+    return solution
+
+def showStartScreen(loader, startTime):
+    '''Shows how far along loader is until it's done, then animates until a
+    key is pressed.  Prints how long after startTime (a time.time()) the
+    screen came up and the loading finished.'''
     frontTitleColor = BLACK
     backTitleColor = DARKBLUE
     titleSurf1 = TITLEFONT.render('Short Circuit', True, backTitleColor)
     titleSurf2 = TITLEFONT.render('Short Circuit', True, frontTitleColor)
 
-    pleaseWaitSurf = BASICFONT.render('Please wait...', True, frontTitleColor)
-    pleaseWaitRect = pleaseWaitSurf.get_rect(midtop = (HALF_WINWIDTH, int(WINHEIGHT*3/4)))
+    loadingPos = (HALF_WINWIDTH, int(WINHEIGHT*3/4))
 
     degrees1 = 0
     degrees2 = 0
-    runningtime = 0
+    firstFrame = True
     dancerx = HALF_WINWIDTH
     dancery = int(WINHEIGHT*3/4)-20
     animate = False
     flashed = False
 
-    dancer = IMAGESDICT['c'][0]
+    dancer = loader.getImage('c')[0]
     dancerRect = dancer.get_rect(center=(dancerx, dancery))
     
     while True:
@@ -1000,9 +1850,10 @@ def showStartScreen():
         DISPLAYSURF.blit(dancer, dancerRect)
 
         if not animate:
-            runningtime = runningtime + 1
-            DISPLAYSURF.blit(pleaseWaitSurf, pleaseWaitRect)
-            if runningtime > 216:
+            loadingSurf = renderText(BASICFONT, 'Loading... %s%%' % (int(100*loader.getProgress())), frontTitleColor)
+            DISPLAYSURF.blit(loadingSurf, loadingSurf.get_rect(midtop = loadingPos))
+            if loader.isDone():
+                print 'Loaded in %.0f ms' % ((time.time() - startTime)*1000)
                 animate = True
         elif animate:
             if not flashed: # start off the animation with a bang!
@@ -1040,6 +1891,9 @@ def showStartScreen():
 
         
         pygame.display.update()
+        if firstFrame:
+            print 'Start screen up in %.0f ms' % ((time.time() - startTime)*1000)
+            firstFrame = False
         FPSCLOCK.tick(FPS)
 
 def drawPressKeyMsg():
@@ -1100,6 +1954,7 @@ def showProfileSelectScreen(profiles):
     messageShowing = False
     profileSelected = False
     firstProfileIndex = 0
+    drawnSurf = None # the display surface last drawn on
     while True:
         checkForQuit()
         checkForToggleFullscreen()
@@ -1107,12 +1962,21 @@ def showProfileSelectScreen(profiles):
         if maxFirstProfileIndex < 0:
            maxFirstProfileIndex = 0
         mouseClicked = False
+        changed = DISPLAYSURF is not drawnSurf
         for event in pygame.event.get():
+            changed = True
             if event.type == MOUSEMOTION:
                 mousePoint = event.pos
             elif event.type == MOUSEBUTTONUP:
                 mousePoint = event.pos
                 mouseClicked = True
+            elif event.type == VIDEOEXPOSE:
+                drawnSurf = None # the window has to be drawn again
+        if not changed:
+            # what's on the screen is still right
+            waitForEvent()
+            continue
+        drawnSurf = DISPLAYSURF
 
         for i in range(len(profileButtons)):
             if firstProfileIndex + i < len(profiles):
@@ -1162,6 +2026,9 @@ def showProfileSelectScreen(profiles):
         FPSCLOCK.tick(FPS)
 
         if mouseClicked:
+            # a click is handled after the frame it was drawn on, so the
+            # next one shows what it did (and the button let go)
+            drawnSurf = None
             profileClickedButton = profileButtons.getClickedButton()
             if profileClickedButton != None:
                 i = profileButtons.index(profileClickedButton)
@@ -1214,11 +2081,16 @@ def createNewProfile(profiles):
     newName = ''
     done = False
     messageShown = False
+    drawnSurf = None # the display surface last drawn on
     while not done:
         checkForQuit()
         checkForToggleFullscreen()
+        changed = DISPLAYSURF is not drawnSurf
         for event in pygame.event.get():
-            if event.type == KEYDOWN:
+            changed = True
+            if event.type == VIDEOEXPOSE:
+                drawnSurf = None # the window has to be drawn again
+            elif event.type == KEYDOWN:
                 if event.key in (K_KP_ENTER, K_RETURN):
                     if len(newName) > 0:
                         done = True
@@ -1228,6 +2100,11 @@ def createNewProfile(profiles):
                 elif len(newName) < 11:
                     if event.unicode not in (u'\r', u'\n', u'\t'):
                         newName += event.unicode
+        if not changed:
+            # what's on the screen is still right
+            waitForEvent()
+            continue
+        drawnSurf = DISPLAYSURF
         DISPLAYSURF.fill(BGCOLOR)
         drawInLevelMessage('Type your name, then press ENTER to begin your training.', None, not messageShown)
         messageShown = True
@@ -1348,16 +2225,26 @@ def showLevelSelectScreen(levelCount, profile):
     firstLevelIndex = profile['highestBlock'] + 1
     tutMessageShown = False
     levelMessageShown = False
+    drawnSurf = None # the display surface last drawn on
     while True:
         mouseClicked = False
         checkForQuit()
         checkForToggleFullscreen()
+        changed = DISPLAYSURF is not drawnSurf
         for event in pygame.event.get():
+            changed = True
             if event.type == MOUSEMOTION:
                 mousePoint = event.pos
             elif event.type == MOUSEBUTTONUP:
                 mousePoint = event.pos
                 mouseClicked = True
+            elif event.type == VIDEOEXPOSE:
+                drawnSurf = None # the window has to be drawn again
+        if not changed:
+            # what's on the screen is still right
+            waitForEvent()
+            continue
+        drawnSurf = DISPLAYSURF
 
         DISPLAYSURF.fill(BGCOLOR)
 
@@ -1390,6 +2277,9 @@ def showLevelSelectScreen(levelCount, profile):
             tutMessageShown = False
 
         if mouseClicked:
+            # a click is handled after the frame it was drawn on, so the
+            # next one shows what it did (and the button let go)
+            drawnSurf = None
             levelClickedButton = levelButtons.getClickedButton()
             if levelClickedButton != None:
                 for i in range(len(levelButtons)):
@@ -1418,28 +2308,188 @@ def showLevelSelectScreen(levelCount, profile):
             levelButtons[i].setColor(BLUE)
             levelButtons[i].setClickedColor(BLACK)
 
+class LevelPack:
+    '''The levels of a levels file, used like the list from readLevelsFile:
+    len(levels) and levels[i].  Only the offset of each level in the file is
+    read up front; a level is parsed the first time it is asked for, and the
+    most recently used ones are kept.'''
+    def __init__(self, filename, cacheSize=LEVEL_PACK_CACHE_SIZE):
+        assert os.path.exists(filename), 'Cannot find the level file: %s' % (filename)
+        self.filename = filename
+        self.cacheSize = cacheSize
+        # (levelDict, DetectionSchedule or None) by level index, least
+        # recently used first
+        self.cache = collections.OrderedDict()
+        self.index = readLevelsCache(filename, LEVELS_INDEX_SUFFIX)
+        if self.index == None:
+            self.index = self.buildIndex()
+            saveLevelsCache(self.index, filename, LEVELS_INDEX_SUFFIX)
+
+    def buildIndex(self):
+        '''Returns a list of (start offset, end offset, line number) of each
+        level in the file.  A level's text runs from the end of the last one
+        to the blank line after its board, as iterLevels reads it.'''
+        index = []
+        levelsFile = open(self.filename, 'rb')
+        offset = 0
+        lineNum = 0
+        levelStart = 0
+        levelStartLine = 0
+        hasBoard = False
+        for line in iter(levelsFile.readline, ''):
+            offset += len(line)
+            lineNum += 1
+            line = line.rstrip('\r\n')
+            if ';' in line:
+                line = line[:line.find(';')]
+            if line != '':
+                if '~' not in line:
+                    hasBoard = True
+            elif hasBoard:
+                index.append((levelStart, offset, levelStartLine))
+                levelStart = offset
+                levelStartLine = lineNum
+                hasBoard = False
+        levelsFile.close()
+        if hasBoard:
+            # the last level, with no blank line after it
+            index.append((levelStart, offset, levelStartLine))
+        return index
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, levelNum):
+        return self.getCached(levelNum)[0]
+
+    def __iter__(self):
+        for levelNum in range(len(self)):
+            yield self[levelNum]
+
+    def getSchedule(self, levelNum):
+        '''Returns the DetectionSchedule of the level, made the first time.'''
+        (levelDict, schedule) = self.getCached(levelNum)
+        if schedule == None:
+            schedule = DetectionSchedule(levelDict)
+            self.cache[levelNum] = (levelDict, schedule)
+        return schedule
+
+    def getCached(self, levelNum):
+        if levelNum < 0:
+            levelNum += len(self)
+        if not 0 <= levelNum < len(self):
+            raise IndexError('level index out of range')
+        if levelNum in self.cache:
+            # move it to the most recently used end
+            cached = self.cache.pop(levelNum)
+        else:
+            cached = (self.parseLevel(levelNum), None)
+        self.cache[levelNum] = cached
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return cached
+
+    def parseLevel(self, levelNum):
+        (start, end, lineNum) = self.index[levelNum]
+        levelsFile = open(self.filename, 'rb')
+        levelsFile.seek(start)
+        content = levelsFile.read(end - start).splitlines(True)
+        levelsFile.close()
+        levels = list(iterLevels(content, self.filename, levelNum, lineNum))
+        assert len(levels) == 1, 'The index of %s is out of date.' % (self.filename)
+        return levels[0]
+
 def readLevelsFile(filename):
-    '''Based on function of the same name by Al S.
-    Returns a list of levelDict's.'''
+    '''Returns a list of levelDict's.  Loads them from the compiled cache
+    next to the file if it is up to date, and parses the file (and rewrites
+    the cache) otherwise.'''
     assert os.path.exists(filename), 'Cannot find the level file: %s' % (filename)
-    levelsFile = open(filename, 'r')
-    content = levelsFile.readlines() + ['\r\n']
+    levels = readLevelsCache(filename)
+    if levels == None:
+        levels = parseLevelsFile(filename)
+        saveLevelsCache(levels, filename)
+    return levels
+
+def getLevelsFileSignature(filename, suffix=LEVELS_CACHE_SUFFIX):
+    '''Returns what the cache of the levels file has to match:
+    (cache version, file size, file mtime, md5 of the contents).  The
+    LevelPack index only goes by (cache version, file size, file mtime),
+    so that opening a pack doesn't read all of it; LevelPack.parseLevel
+    catches an index that is out of date anyway.'''
+    if suffix == LEVELS_INDEX_SUFFIX:
+        return (LEVELS_CACHE_VERSION, os.path.getsize(filename),
+                os.path.getmtime(filename))
+    contentHash = hashlib.md5()
+    levelsFile = open(filename, 'rb')
+    for chunk in iter(lambda: levelsFile.read(65536), ''):
+        contentHash.update(chunk)
     levelsFile.close()
+    return (LEVELS_CACHE_VERSION, os.path.getsize(filename),
+            os.path.getmtime(filename), contentHash.hexdigest())
+
+def readLevelsCache(filename, suffix=LEVELS_CACHE_SUFFIX):
+    '''Returns what was saved in the cache of the levels file (the list of
+    levelDict's, or the LevelPack index if suffix is LEVELS_INDEX_SUFFIX), or
+    None if there's no cache or it is out of date or unreadable.'''
+    cacheFilename = filename + suffix
+    if not os.path.exists(cacheFilename):
+        return None
+    try:
+        cacheFile = open(cacheFilename, 'rb')
+        try:
+            signature = marshal.load(cacheFile)
+            if signature != getLevelsFileSignature(filename, suffix):
+                return None
+            return marshal.load(cacheFile)
+        finally:
+            cacheFile.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+
+def saveLevelsCache(levels, filename, suffix=LEVELS_CACHE_SUFFIX):
+    '''Writes the cache of the levels file.  Returns True if it could.'''
+    try:
+        cacheFile = open(filename + suffix, 'wb')
+        try:
+            marshal.dump(getLevelsFileSignature(filename, suffix), cacheFile)
+            marshal.dump(levels, cacheFile)
+        finally:
+            cacheFile.close()
+    except (IOError, OSError):
+        # e.g. a read-only install; we'll just parse again next time
+        return False
+    return True
 
+def parseLevelsFile(filename):
+    '''Based on function of the same name by Al S.
+    Returns a list of levelDict's.'''
+    levelsFile = open(filename, 'r')
+    try:
+        return list(iterLevels(levelsFile, filename))
+    finally:
+        levelsFile.close()
+
+def iterLevels(levelsFile, filename=None, firstLevelNum=0, firstLineNum=0):
+    '''Yields the levelDict's in levelsFile, a file object or any other
+    iterable of lines, one at a time as each level's blank line is read, so
+    only one level is ever in memory.  filename, firstLevelNum and
+    firstLineNum are for the error messages.'''
+    if filename == None:
+        filename = getattr(levelsFile, 'name', '<levels>')
     buildingDict = {'red dish'  : ('w', '2', '1', 'q', 'a', 's'),
                     'blue dish' : ('r', '4', '3', 'e', 'd', 'f'),
                     'player'    : '@',
                     'wall'      : '#',
                     'goal'      : '*'}
 
-    levels = [] # list of level dictionaries
-    levelNum = 0
+    levelNum = firstLevelNum
     boardTextLines = [] # lines for a single level's board
     levelMessages = [] # list of the messages to be displayed during the level
     # the messages are tuples (turnNumber, personSpeaking, message), and are in
     # chronological order
-    for lineNum in range(len(content)):
-        line = content[lineNum].rstrip('\r\n')
+    # the blank line at the end finishes the last level
+    for lineNum, line in enumerate(itertools.chain(levelsFile, ['\r\n']), firstLineNum):
+        line = line.rstrip('\r\n')
 
         if ';' in line:
             # ignore, comment
@@ -1503,15 +2553,17 @@ def readLevelsFile(filename):
             # basic level design sanity check
             assert playerAddress != None, 'Level %s (around line %s) in %s is missing a "@" to mark the start point.' % (levelNum+1, lineNum, filename)
             assert len(goalAddresses) > 0, 'Level %s (around line %s) in %s is missing a "*" to mark the goal.' % (levelNum+1, lineNum, filename)
+            # tuples, so that a level can be played over and over without
+            # being copied; what changes during play is kept in a GameState
             levelDict = {'width'    : maxWidth,
                          'height'   : height,
-                         'wallAddresses'    : wallAddresses,
-                         'goalAddresses'    : goalAddresses,
+                         'wallAddresses'    : tuple(wallAddresses),
+                         'goalAddresses'    : tuple(goalAddresses),
                          'playerAddress'    : playerAddress,
-                         'dishes'   : dishes,
-                         'messages' : levelMessages}
+                         'dishes'   : tuple(dishes),
+                         'messages' : tuple(levelMessages)}
 
-            levels.append(levelDict)
+            yield levelDict
 
             # Reset variables for reading next board
             levelNum += 1
@@ -1519,8 +2571,6 @@ def readLevelsFile(filename):
             levelMessages = []
             levelDict = {}
 
-    return levels
-
 def readProfilesFile(filename):
     '''Returns a list of profile objects.  Could be empty.
     In their dictionary:
@@ -1567,6 +2617,16 @@ def saveProfilesFile(profiles, filename):
     profilesFile.close()
     return True
 
+def waitForEvent():
+    '''Sleeps until something happens, and leaves what happened in the event
+    queue, in order, for the screen's own event handling.  Screen loops call
+    it instead of FPSCLOCK.tick once the screen is up to date, so a screen
+    nobody is touching uses no CPU, and input is still handled as soon as it
+    comes in.'''
+    events = [pygame.event.wait()] + pygame.event.get()
+    for event in events:
+        pygame.event.post(event)
+
 def checkForQuit():
     for event in pygame.event.get(QUIT): # get all the QUIT events
         terminate() # terminate if any QUIT events are present
@@ -1608,23 +2668,74 @@ def toggleFullscreen():
     
     return screen
 
+class Fade:
+    '''A fade of the screen to a color, by how much time has gone by rather
+    than by frames, so it takes fadetime (in milliseconds) however long the
+    frames take.  It doesn't block: call update() each frame until it
+    returns False, or finish() to run it out.  Only one fade at a time.'''
+    def __init__(self, fadeColor, fadetime, fadeBack=False, endAlpha=255):
+        '''fadeBack fades back to the original screen afterward, taking
+        fadetime again.  endAlpha is how far the color covers the screen.'''
+        self.fadetime = fadetime
+        self.fadeBack = fadeBack
+        self.endAlpha = endAlpha
+        (self.oldScreen, self.overlay) = getFadeSurfaces()
+        self.oldScreen.blit(DISPLAYSURF, (0, 0))
+        self.overlay.fill(fadeColor)
+        self.startTime = pygame.time.get_ticks()
+        self.done = False
+
+    def getDuration(self):
+        if self.fadeBack:
+            return 2*self.fadetime
+        return self.fadetime
+
+    def getAlpha(self, elapsed):
+        '''Returns the alpha of the color elapsed milliseconds in.'''
+        if elapsed >= self.getDuration():
+            if self.fadeBack:
+                return 0
+            return self.endAlpha
+        fraction = float(elapsed)/self.fadetime
+        if fraction > 1:
+            # on the way back
+            fraction = 2 - fraction
+        return int(self.endAlpha*fraction)
+
+    def isDone(self):
+        return self.done
+
+    def update(self):
+        '''Draws the fade as it is now.  Returns False once its last frame
+        has been drawn.'''
+        if self.done:
+            return False
+        elapsed = pygame.time.get_ticks() - self.startTime
+        self.overlay.set_alpha(self.getAlpha(elapsed))
+        DISPLAYSURF.blit(self.oldScreen, (0, 0))
+        DISPLAYSURF.blit(self.overlay, (0, 0))
+        pygame.display.update()
+        self.done = elapsed >= self.getDuration()
+        return not self.done
+
+    def finish(self):
+        '''Runs the fade to its end.'''
+        while self.update():
+            FPSCLOCK.tick(FPS)
+
+def getFadeSurfaces():
+    '''Returns (screen copy, overlay), made the first time for the screen's
+    size and used by every Fade after.'''
+    size = DISPLAYSURF.get_size()
+    if size not in FADESURFS:
+        FADESURFS[size] = (DISPLAYSURF.copy(), DISPLAYSURF.copy())
+    return FADESURFS[size]
+
 def fadeToColor(fadeColor, fadetime, fadeBack=False, endAlpha=255):
     '''Fades to the color over the fadetime (in milliseconds).
-        Optional boolean can make it fade back to the original screen afterward.'''
-    alphaRanges = [(0, endAlpha, 1)]
-    if fadeBack:
-        alphaRanges.append((endAlpha, 0, -1))
-
-    oldScreen = DISPLAYSURF.copy()
-    overlay = DISPLAYSURF.copy()
-    for (start, end, multiplier) in alphaRanges:
-        for a in range(start, end, multiplier*int(255/(fadetime*FPS/1000))):
-            overlay.fill(fadeColor)
-            overlay.set_alpha(a)
-            DISPLAYSURF.blit(oldScreen, (0, 0))
-            DISPLAYSURF.blit(overlay, (0, 0))
-            pygame.display.update()
-            FPSCLOCK.tick(FPS)
+        Optional boolean can make it fade back to the original screen afterward.
+        Returns when the fade is over; see Fade for one that doesn't.'''
+    Fade(fadeColor, fadetime, fadeBack, endAlpha).finish()
 
 def terminate():
     fadeToColor(BLACK, 1000, False, 127)
@@ -1678,9 +2789,24 @@ def terminate():
                 if clickedButton == yesButton:
                     break
                 elif clickedButton == cancelButton:
+                    # the fade and the dialog are still over the screen
+                    pygame.event.post(pygame.event.Event(VIDEOEXPOSE))
                     return
     pygame.quit()
     sys.exit()
        
 if __name__ == '__main__':
-    main()
+    multiprocessing.freeze_support()
+    if len(sys.argv) > 1 and sys.argv[1] == '--verify':
+        # check the level pack instead of playing:
+        # shortCircuit.py --verify [levels file]
+        if len(sys.argv) > 2:
+            filename = sys.argv[2]
+        else:
+            filename = LEVELS_FILENAME
+        if verifyLevels(filename):
+            sys.exit(0)
+        else:
+            sys.exit(1)
+    else:
+        main()
@@ -0,0 +1,149 @@
+'''
+Gym-style environment for Short Circuit.
+
+ShortCircuitEnv wraps the levels from readLevelsFile behind reset(levelIndex)
+and step(action), so agents can be trained and benchmarked on the real
+puzzles.  It steps a GameState and opens no display unless it is made with
+renderMode='human', in which case render() draws the level with the game's
+own Gameboard and sprites.
+
+Observations are dictionaries:
+'walls', 'goals', 'detected': boolean NumPy arrays indexed [y, x] of the
+    walls, the goals not yet reached and the hexes detected this turn
+'player': (x, y) address of the player
+'turn': the turn counter
+
+Needs NumPy, which the game itself does not.
+'''
+
+import os
+import numpy
+import pygame
+import shortCircuit
+
+# actions are the directions, RIGHT (0) to DOWNRIGHT (5)
+ACTIONS = (shortCircuit.RIGHT, shortCircuit.UPRIGHT, shortCircuit.UPLEFT,
+           shortCircuit.LEFT, shortCircuit.DOWNLEFT, shortCircuit.DOWNRIGHT)
+
+GOAL_REWARD = 1.0
+COMPLETE_REWARD = 10.0
+DETECTED_REWARD = -10.0
+
+
+class ShortCircuitEnv:
+    def __init__(self, filename=None, renderMode=None):
+        '''filename is a level pack, data/sclevels.data if not given.
+        renderMode is None (no display) or 'human'.'''
+        if filename == None:
+            filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'sclevels.data')
+        assert renderMode in (None, 'human'), 'Unknown render mode: %s' % (renderMode)
+        self.levels = shortCircuit.readLevelsFile(filename)
+        self.renderMode = renderMode
+        # game states and observation grids, built the first time a level is reset
+        self.levelCache = {}
+        self.levelIndex = None
+        self.state = None
+        self.gameboard = None
+
+    def getLevelCount(self):
+        return len(self.levels)
+
+    def getState(self):
+        '''Returns the GameState of the current level.'''
+        return self.state
+
+    def reset(self, levelIndex=0):
+        '''Starts the level over.  Returns the first observation.'''
+        if levelIndex not in self.levelCache:
+            levelDict = self.levels[levelIndex]
+            schedule = shortCircuit.DetectionSchedule(levelDict)
+            bitboard = schedule.getBitboard()
+            wallGrid = self.getGrid(bitboard, bitboard.getWalls())
+            detectedGrids = [self.getGrid(bitboard, schedule.getDetectedMask(turn))
+                             for turn in range(schedule.getPeriod())]
+            # these are handed out in every observation, so keep them safe
+            for grid in [wallGrid] + detectedGrids:
+                grid.setflags(write=False)
+            state = shortCircuit.GameState(levelDict, schedule)
+            goalGrid = self.getGrid(bitboard, bitboard.getMask(levelDict['goalAddresses']))
+            self.levelCache[levelIndex] = (state, wallGrid, detectedGrids, goalGrid)
+        (self.state, self.wallGrid, self.detectedGrids, startGoalGrid) = self.levelCache[levelIndex]
+
+        self.levelIndex = levelIndex
+        self.state.reset()
+        self.goalGrid = startGoalGrid.copy()
+        if self.renderMode == 'human':
+            self.setupRendering()
+        return self.getObservation()
+
+    def step(self, action):
+        '''Plays one move.  Returns (observation, reward, done, info); info has
+        'moved' (False if the move wasn't possible and no turn passed) and
+        'complete' (True if the level was won).'''
+        state = self.state
+        moved = state.step(action)
+        reward = 0.0
+        if state.hasCollectedGoal():
+            (x, y) = state.getPlayerAddress()
+            self.goalGrid[y, x] = False
+            reward += GOAL_REWARD
+            if self.gameboard != None:
+                self.gameboard.markGoalAt((x, y))
+        if moved and state.isPlayerDetected():
+            reward += DETECTED_REWARD
+        elif moved and state.isComplete():
+            reward += COMPLETE_REWARD
+        done = state.isPlayerDetected() or state.areGoalsAchieved()
+        info = {'moved':    moved,
+                'complete': state.isComplete()}
+        return self.getObservation(), reward, done, info
+
+    def getObservation(self):
+        return {'walls':    self.wallGrid,
+                'goals':    self.goalGrid.copy(),
+                'detected': self.detectedGrids[self.state.getTurn() % len(self.detectedGrids)],
+                'player':   self.state.getPlayerAddress(),
+                'turn':     self.state.getTurn()}
+
+    def getGrid(self, bitboard, mask):
+        '''Returns a boolean array [y, x] of the bits set in mask.'''
+        grid = numpy.zeros((bitboard.getHeight(), bitboard.getWidth()), numpy.bool_)
+        for (x, y) in bitboard.getAddresses(mask):
+            grid[y, x] = True
+        return grid
+
+    def setupRendering(self):
+        '''Opens the window the first time, then builds the level's board and
+        sprites.  Image paths are relative to the game folder, as in main().'''
+        if pygame.display.get_surface() == None:
+            pygame.init()
+            shortCircuit.DISPLAYSURF = pygame.display.set_mode((shortCircuit.WINWIDTH, shortCircuit.WINHEIGHT))
+            pygame.display.set_caption('Short Circuit')
+            shortCircuit.IMAGESDICT = shortCircuit.loadImagesDict()
+        levelDict = self.levels[self.levelIndex]
+        self.gameboard = shortCircuit.buildGameboard(levelDict)
+        self.player = shortCircuit.PlayerSprite(levelDict['playerAddress'])
+        self.dishList = [shortCircuit.DishSprite(tint, address, facing)
+                         for (tint, address, facing) in levelDict['dishes']]
+        self.movingSprites = pygame.sprite.Group(self.player)
+        self.dishSprites = pygame.sprite.Group(*self.dishList)
+
+    def render(self):
+        '''Draws the level in the window, if renderMode is 'human'.'''
+        if self.renderMode != 'human':
+            return
+        pygame.event.pump()
+        self.player.setAddress(self.state.getPlayerAddress())
+        self.player.setFacing(self.state.getPlayerFacing())
+        for dish, facing in zip(self.dishList, self.state.getDishFacings()):
+            dish.setFacing(facing)
+        shortCircuit.DISPLAYSURF.fill(shortCircuit.BGCOLOR)
+        shortCircuit.drawGameboard(self.gameboard, self.movingSprites, self.dishSprites)
+        shortCircuit.DISPLAYSURF.blit(self.gameboard.getSurface(), self.gameboard.getPos())
+        pygame.display.update()
+
+    def close(self):
+        if self.gameboard != None:
+            pygame.display.quit()
+            shortCircuit.DISPLAYSURF = None
+            self.gameboard = None